@@ -48,6 +48,13 @@ if not config:
     TWITTER_CONSUMER_SECRET = config["TWITTER"]["TWITTER_CONSUMER_SECRET"]
     TWITTER_ACCESS_TOKEN = config["TWITTER"]["TWITTER_ACCESS_TOKEN"]
     TWITTER_ACCESS_TOKEN_SECRET = config["TWITTER"]["TWITTER_ACCESS_TOKEN_SECRET"]
+    # optional, only needed for sending email notifications
+    SMTP_HOST = config.get("SMTP", "SMTP_HOST", fallback="localhost")
+    SMTP_PORT = config.getint("SMTP", "SMTP_PORT", fallback=25)
+    SMTP_USER = config.get("SMTP", "SMTP_USER", fallback="")
+    SMTP_PWD = config.get("SMTP", "SMTP_PWD", fallback="")
+    SMTP_SENDER = config.get("SMTP", "SMTP_SENDER", fallback="")
+    SMTP_STARTTLS = config.getboolean("SMTP", "SMTP_STARTTLS", fallback=False)
 
 # Initialize app
 app = FastAPI(docs_url=None, redoc_url=None)
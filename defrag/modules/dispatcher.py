@@ -1,16 +1,27 @@
 
 from asyncio.tasks import Task, wait_for
 from datetime import datetime
-from defrag import LOGGER, app
+from defrag import LOGGER, SMTP_HOST, SMTP_PORT, SMTP_PWD, SMTP_SENDER, SMTP_STARTTLS, SMTP_USER, app
 from defrag.modules.helpers import Query, QueryResponse
 from defrag.modules.db.redis import RedisPool
 from defrag.modules.helpers.requests import Req
-from defrag.modules.helpers.data_manipulation import dropwhile_takeif
+from defrag.modules.helpers.broadcast import RedisBroadcast
+from defrag.modules.helpers.data_manipulation import stable_digest
+from defrag.modules.helpers.leader_election import LeaderElection, LeaseLock
+from defrag.modules.helpers.queues import LANES, MemoryQueue, RedisStreamQueue
+from defrag.modules.helpers.services_manager import ServicesManager
+from defrag.modules.helpers.smtp import SMTPPool
+from defrag.modules.helpers.streams import CursoredStream
 from defrag.modules.helpers.sync_utils import as_async, run_redis_jobs
-from pottery import RedisSet, RedisDict, RedisDeque
+from pottery import RedisSet, RedisDict
+from fastapi import Header
+from redis.client import Pipeline
+from fastapi.responses import StreamingResponse
+from functools import partial
 from pydantic import BaseModel
-from typing import Any, Dict, List, Optional, Union
+from typing import Any, AsyncGenerator, Callable, Coroutine, Dict, List, Optional, Tuple, Union
 import asyncio
+import json
 
 __MODULE_NAME__ = "dispatcher"
 
@@ -36,230 +47,597 @@ class TelegramNotification(Notification):
     bot_endpoint: Optional[str]
 
 
+class Destination(BaseModel):
+    """ Where a topic subscriber wants the topic's notifications, merged into each notification at fan-out time. """
+    user_id: Optional[int]
+    chat_id: Optional[int]
+    bot_endpoint: Optional[str]
+    email_address: Optional[str]
+
+
+class TopicSubscription(BaseModel):
+    topic: str
+    subscriber_id: str
+    destination: Destination
+
+
 class Dispatchable(BaseModel):
     origin: str
     notification: Notification
+    # when set, the notification is stored once and delivered to each of the topic's subscribers
+    topic: Optional[str] = None
     retries: int = 0
+    # one of the queue's LANES, defaulting to 'reminder' for scheduled items and 'immediate' otherwise
+    priority: Optional[str] = None
+    attempts: List[Dict[str, Any]] = []
     schedules: List[float] = []
     id: Optional[str] = None
 
 
 class HashedDispatchable(Dispatchable):
 
-    id: Optional[int] = None
-
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.id = self.id or str(abs(hash(str(self.notification))))
+        # the same notification from another origin or for other times is another item
+        self.id = self.id or stable_digest([self.origin, self.notification.dict(), sorted(self.schedules)])
         self.schedules = sorted(self.schedules, reverse=True)
 
 
 class Dispatcher:
     """
     STRUCTURE
-    - Clients can subscribe as pushees, pollers, or both. Subscription is not implemented yet.
+    - Clients can subscribe as pushees, pollers, or both. Pollers get a cursor on the due notifications, pushees subscribe
+        to topics: a dispatchable with a topic is stored once and fanned out to the topic's subscribers when dispatched.
     - Pushees should be ready to handle HTTP requests (typically bots running on applications exposing POST endpoints).
     - The Dispatcher acts as message broker that receives 'dispatchables' (i.e. any incoming data payload) on a single async queue, and consumes them as
         either 'schedulables' (dispatchables with an explicit schedule value) or sends them immediately otherwise.
+    - The queue has priority lanes (see LANES), consumed by weighted round-robin, so that bulk ingestion
+        does not delay immediate notifications. The queue is in-memory by default. Passing a RedisStreamQueue to 'run' makes it durable and lets several replicas
+        share the work, with at-least-once delivery.
+    - Every replica consumes the queue, but only the elected leader ticks the clock and runs the other 'leader_jobs',
+        the others standing by until the leader's lease expires.
     - The Dispatcher does not handle calendar items (see the 'calendar' module. However it handles the notifications which clients register
         under particular calendar items. In particular, each occurrence -- when calendar items are repeated, i.e. a bi-weekly meeting
         is handled separately.
 
     TODO:
-    - Add functionality for un/subscribing clients.
     - Add confirmation for all new subscriptions, with the confirmation not being a response but a
     call back testing the pushee's endpoint.
     """
 
-    process_q: asyncio.Queue
+    process_q: Union[MemoryQueue, RedisStreamQueue]
     running_workers: Dict[str, Task] = {}
+    # jobs that must run on a single replica at a time, keyed by name
+    leader_jobs: Dict[str, Callable[[], Coroutine]] = {
+        "services_monitor": ServicesManager.start_monitor}
+    election: Optional[LeaderElection] = None
+    # payloads of the scheduled items, stored once under their id
     scheduled = RedisDict({}, redis=RedisPool().connection,
                           key="scheduled_items")
-    unscheduled_items_ids = RedisSet(
-        [], redis=RedisPool().connection, key="unscheduled_items_ids")
+    # sorted set of all the occurrences (see 'occurrence') of all scheduled items, scored by due timestamp
+    due_index_key = "scheduled_items_due_index"
+    # atomic writes over 'scheduled', its due index and the item's own set of occurrences:
+    # KEYS = [scheduled, due index, occurrences], ARGV = [encoded id, ...]
+    scheduling = RedisPool().connection.register_script("""
+    if redis.call('HSETNX', KEYS[1], ARGV[1], ARGV[2]) == 0 then
+        return 0
+    end
+    for n = 3, #ARGV, 2 do
+        redis.call('ZADD', KEYS[2], ARGV[n + 1], ARGV[n])
+        redis.call('SADD', KEYS[3], ARGV[n])
+    end
+    return 1
+    """)
+    extending = RedisPool().connection.register_script("""
+    redis.call('HSETNX', KEYS[1], ARGV[1], ARGV[2])
+    for n = 3, #ARGV, 2 do
+        redis.call('ZADD', KEYS[2], ARGV[n + 1], ARGV[n])
+        redis.call('SADD', KEYS[3], ARGV[n])
+    end
+    return 1
+    """)
+    consuming = RedisPool().connection.register_script("""
+    redis.call('ZREM', KEYS[2], ARGV[2])
+    redis.call('SREM', KEYS[3], ARGV[2])
+    if redis.call('SCARD', KEYS[3]) == 0 then
+        redis.call('HDEL', KEYS[1], ARGV[1])
+    end
+    return 1
+    """)
+    unscheduling = RedisPool().connection.register_script("""
+    local occurrences = redis.call('SMEMBERS', KEYS[3])
+    for n = 1, #occurrences, 1000 do
+        redis.call('ZREM', KEYS[2], unpack(occurrences, n, math.min(n + 999, #occurrences)))
+    end
+    redis.call('DEL', KEYS[3])
+    return redis.call('HDEL', KEYS[1], ARGV[1])
+    """)
     subscribed_pushees = RedisSet(
         [], redis=RedisPool().connection, key="subscribed_pushees")
     subscribed_pollers = RedisSet(
         [], redis=RedisPool().connection, key="subscribed_pollers")
-    due_for_polling_notifications = RedisDeque(
-        [], redis=RedisPool().connection, key="due_for_polling_notifications")
-    due_last_poll: Optional[float] = None
+    # read by each subscribed poller from its own cursor
+    due_for_polling_notifications = CursoredStream(
+        "due_for_polling_notifications")
+    # notifications that could not be delivered after all retries, with their last error and attempts history
+    dead_letters = CursoredStream("dead_letters", maxlen=100000)
+    max_retries: int = 3
+    # how many topic subscribers are read and delivered to at a time
+    fanout_batch_size: int = 100
+    # email notifications are sent over these sessions, rather than pushed over HTTP
+    smtp_pool = SMTPPool(SMTP_HOST, SMTP_PORT, SMTP_USER,
+                         SMTP_PWD, SMTP_SENDER, SMTP_STARTTLS)
+    # wakes up long-polling and streaming clients when items become due, whichever replica dispatched them
+    due_signal = RedisBroadcast("due_for_polling_signal")
 
     @classmethod
-    def run(cls, seconds: int = 60) -> None:
+    def run(cls, seconds: int = 60, queue: Optional[Union[MemoryQueue, RedisStreamQueue]] = None) -> None:
         """ 
         Initializes the queue and launch the two consumers. 
         This is made sync to make it easier to use in any context.
         """
-        cls.process_q = asyncio.Queue()
+        cls.process_q = queue or MemoryQueue()
         # schedules a task to consume all dispatchables, as they come
         cls.running_workers["processor"] = asyncio.create_task(
             cls.start_polling_process())
-        # schedules a task to consume all and only the 'schedulable' dispatchables,
+        # relays the 'due for polling' signal to long-polling and streaming clients
+        cls.running_workers["due_listener"] = asyncio.create_task(
+            cls.due_signal.listen())
+        # campaigns for leadership, to consume all and only the 'schedulable' dispatchables,
         # typically calendar notifications, at a  set interval. 1 minute looks OK.
-        cls.running_workers["clock"] = asyncio.create_task(
-            cls.start_ticking_clock(seconds))
+        jobs = {"clock": lambda: cls.start_ticking_clock(seconds), **cls.leader_jobs}
+        cls.election = LeaderElection(LeaseLock("dispatcher_leader"), jobs)
+        cls.running_workers["election"] = asyncio.create_task(
+            cls.election.campaign())
 
     @classmethod
     def stop(cls) -> None:
         for t in cls.running_workers.values():
             t.cancel()
+        cls.due_signal.close()
+        if cls.election:
+            cls.election.resign()
+            cls.election = None
 
     @classmethod
-    async def put(cls, dispatchable: Union[Dispatchable, Dict[str, Any]]) -> None:
+    async def put(cls, dispatchable: Union[Dispatchable, Dict[str, Any]], lane: Optional[str] = None) -> None:
         """ 
-        Ensures that the input is a unique dispatchable and puts it into the queue.
+        Ensures that the input is a unique dispatchable and puts it into the queue, in the lane matching its priority
+        unless another 'lane' is given (typically 'bulk' when ingesting many items at once).
         Performance may favor a different way of unpacking the inner dispatchable.
         """
+        item = cls.as_item(dispatchable)
+        lane = lane or item.get("priority") or (
+            "reminder" if item["schedules"] else "immediate")
+        if not lane in LANES:
+            raise Exception(f"Cannot process items with an unknown priority: {lane}")
+        await cls.process_q.put(item, lane)
+
+    @staticmethod
+    def as_item(dispatchable: Union[Dispatchable, Dict[str, Any]]) -> Dict[str, Any]:
+        """ The dispatchable as a dict, with its id and its schedules sorted. """
+        # passing the notification as is keeps the fields of its subclass
         item = HashedDispatchable(
-            **dispatchable.dict()
+            **{**dispatchable.dict(), "notification": dispatchable.notification}
         ).dict() if isinstance(dispatchable, Dispatchable) else dispatchable
         if not "id" in item:
             raise Exception("Cannot process items without id!")
-        await cls.process_q.put(item)
+        return item
 
     @classmethod
     async def start_polling_process(cls) -> None:
         """
         Dispatches the item just in case it is not a scheduled item. Otherwise 
         adds to the scheduled items, if its id is not already keyed in the scheduled dict.
+        Items are acknowledged only once processed, so that a durable queue can redeliver them after a crash.
         """
         await as_async(LOGGER.info)("Started to poll the process queue.")
         while True:
-            item = await cls.process_q.get()
-            if not item["schedules"]:
-                await cls.dispatch(item)
-            elif not item["id"] in cls.scheduled:
-                cls.scheduled[item["id"]] = item
-            cls.process_q.task_done()
+            receipt, item = await cls.process_q.get()
+            try:
+                if not item["schedules"]:
+                    await cls.dispatch([item])
+                else:
+                    await as_async(cls.schedule)(item)
+            except Exception as error:
+                await as_async(LOGGER.error)(f"Unable to process {item}: {error}")
+            else:
+                await cls.process_q.ack(receipt)
 
     @classmethod
     async def start_ticking_clock(cls, interval: int) -> None:
         """ 
-        Every {interval}, monitor the scheduled set for due items.
-        Looks for the last 'schedule' occurrence (i.e. a particular notification 
-        and dispatches it. Notice that this behaviour assumes that the interval between 'schedules'
-        is not smaller than the interval of 'start_ticking_clock'.
+        Every {interval}, looks up the due index for the occurrences (i.e. a particular notification) which are due,
+        and dispatches them along with their item's payload.
+        Checks the leader's fencing token before each tick, so that a leader superseded while paused does not dispatch.
         """
         await as_async(LOGGER.info)("Started to monitor scheduled items")
         while True:
             await asyncio.sleep(interval)
-            now_timestamp = datetime.now().timestamp()
-            due = [v for v in cls.scheduled.values() if v["schedules"]
-                   [-1] < now_timestamp]
-            if due:
-                await wait_for(cls.dispatch(due), timeout=3)
+            try:
+                if cls.election and not await cls.election.validate():
+                    continue
+                due = await as_async(cls.due_items)(datetime.now().timestamp())
+                if due:
+                    await wait_for(cls.dispatch(due), timeout=max(interval, 3))
+            except Exception as error:
+                # the occurrences left due are picked up by the next tick
+                await as_async(LOGGER.error)(f"Clock tick failed: {error!r}")
+
+    @staticmethod
+    def occurrence(item_id: str, due: float) -> str:
+        """ Member of the due index standing for one occurrence of a scheduled item. """
+        return json.dumps([item_id, due])
+
+    @classmethod
+    def schedule_keys(cls, item_id: str) -> List[str]:
+        return [cls.scheduled.key, cls.due_index_key, f"scheduled_items_occurrences_{item_id}"]
+
+    @classmethod
+    def due_items(cls, now: float) -> List[Dict[str, Any]]:
+        """ One item per due occurrence, with this occurrence as its only 'schedules' value. """
+        with RedisPool() as conn:
+            occurrences = [json.loads(m) for m in conn.zrangebyscore(cls.due_index_key, "-inf", now)]
+            if not occurrences:
+                return []
+            ids = list(dict.fromkeys(item_id for item_id, _ in occurrences))
+            payloads = dict(zip(ids, conn.hmget(cls.scheduled.key, [cls.scheduled._encode(i) for i in ids])))
+        return [{**cls.scheduled._decode(payloads[item_id]), "schedules": [due]}
+                for item_id, due in occurrences if payloads[item_id]]
+
+    @classmethod
+    def schedule(cls, item: Dict[str, Any], client: Optional[Pipeline] = None) -> bool:
+        """ 
+        Stores the item's payload once, and each of its occurrences in the due index, unless an item with the same id is scheduled already.
+        O(log(n)) per occurrence. Given a pipeline as 'client', only queues the script call into it.
+        """
+        occurrences = [arg for due in item["schedules"] for arg in [cls.occurrence(item["id"], due), due]]
+        return bool(cls.scheduling(keys=cls.schedule_keys(item["id"]), args=[
+            cls.scheduled._encode(item["id"]), cls.scheduled._encode({**item, "schedules": []}), *occurrences], client=client))
+
+    @classmethod
+    def schedule_many(cls, dispatchables: List[Union[Dispatchable, Dict[str, Any]]], pipe: Optional[Pipeline] = None) -> None:
+        """ 
+        Schedules the dispatchables straight away, in one round trip, rather than through the queue. 
+        Given a pipeline, queues the writes into it for the caller to execute along with its own.
+        """
+        with RedisPool(pipeline=True) as own_pipe:
+            for d in dispatchables:
+                cls.schedule(cls.as_item(d), client=pipe or own_pipe)
+            if not pipe:
+                own_pipe.execute()
 
     @classmethod
-    async def unschedule(cls, item_id: str) -> None:
-        """ Unschedule (marks for cancellation) a scheduled items. """
-        found = [k for k in cls.scheduled.keys() if k == item_id]
-        if found:
-            await as_async(cls.unscheduled_items_ids.add)(item_id)
+    def extend(cls, item: Dict[str, Any]) -> None:
+        """ Adds the item's occurrences to those already scheduled under its id, storing the item first if none are left. """
+        occurrences = [arg for due in item["schedules"] for arg in [cls.occurrence(item["id"], due), due]]
+        cls.extending(keys=cls.schedule_keys(item["id"]), args=[
+            cls.scheduled._encode(item["id"]), cls.scheduled._encode({**item, "schedules": []}), *occurrences])
+
+    @classmethod
+    def consume(cls, item_id: str, due: float) -> None:
+        """ Removes a dispatched occurrence, and the item's payload along with its last occurrence. """
+        cls.consuming(keys=cls.schedule_keys(item_id), args=[
+            cls.scheduled._encode(item_id), cls.occurrence(item_id, due)])
+
+    @classmethod
+    def unschedule_now(cls, item_id: str) -> bool:
+        return bool(cls.unscheduling(keys=cls.schedule_keys(item_id), args=[
+            cls.scheduled._encode(item_id)]))
+
+    @classmethod
+    async def unschedule(cls, item_id: str) -> bool:
+        """ Removes a scheduled item and all its occurrences in one atomic step. Returns whether the item was found. """
+        return await as_async(cls.unschedule_now)(item_id)
 
     @classmethod
     async def dispatch(cls, items: List[Dict[str, Any]]) -> None:
         """
-        The dispatcher looks up the 'unscheduled' set, to see if the item being processed is found there. 
-        If found, the item is removed from the set and discarded. 
-        If not found, the item is has its notification payload either added to a queue available for external applications to poll, or tried for push/sending.
-        If the push/sending fails, the item is sent to the queue again unless it has been retried 3 times already (discarded if so). 
-        If the sending succeeds, the item is rescheduled if it has remaining scheduled times. Otherwise it is removed from the the scheduled items.
+        The item has its notification payload either added to a queue available for external applications to poll, or tried for push/sending.
+        Items with a topic are fanned out from the process queue rather than here, see 'fan_out'.
+        If the item is a due occurrence of a scheduled item, the occurrence is removed from the due index, and the scheduled item along with its last occurrence.
+        If the push/sending fails, the item is sent to the queue again unless it has been retried 3 times already (dead-lettered if so). 
         """
         await as_async(LOGGER.info)(f"Called dispatch with {len(items)}")
         now_tmp = datetime.now().timestamp()
-        to_push = []
+        to_deliver = []
+        to_fan_out = []
         redis_jobs = []
 
-        def deleting(id: int) -> None:
-            cls.scheduled.__delitem__(id)
-            #LOGGER.info(f"Deleting {id}")
-
-        def removing(id: int) -> None:
-            cls.unscheduled_items_ids.remove(id)
-            deleting(id)
-            #LOGGER.info(f"Removing {id}")
-
         def polling(item: Dict[str, Any]) -> None:
             item["notification"]["dispatched"] = now_tmp
-            cls.due_for_polling_notifications.appendleft(item)
+            cls.due_for_polling_notifications.append(item)
             #LOGGER.info(f"Polling {item}")
 
-        def rescheduling(item: Dict[str, Any]) -> None:
-            cls.scheduled[item["id"]] = item
-            #LOGGER.info(f"Scheduling {item}")
-
         for i in items:
-            if i["id"] in cls.unscheduled_items_ids:
-                redis_jobs.append(lambda: removing(i["id"]))
-                #LOGGER.info(f"To remove {i['id']}")
-
             if i["notification"]["poll_do_not_push"]:
-                redis_jobs.append(lambda: polling(i))
+                redis_jobs.append(partial(polling, i))
                 #LOGGER.info(f"To poll {i}")
 
+            elif i.get("topic"):
+                to_fan_out.append(i)
+
             else:
-                to_push.append(cls.push(i))
+                to_deliver.append(i)
                 #LOGGER.info(f"To push {i}")
 
             if i["schedules"]:
-                i["schedules"].pop()
-            if not i["schedules"]:
-                redis_jobs.append(lambda: deleting(i["id"]))
-                #LOGGER.info(f"To delete {i['id']}")
+                redis_jobs.append(partial(cls.consume, i["id"], i["schedules"][-1]))
+
+        if any(i["notification"]["poll_do_not_push"] for i in items):
+            redis_jobs.append(cls.due_signal.publish)
 
+        # bookkeeping first, so that a slow delivery cannot leave due items behind for the next tick
+        await as_async(run_redis_jobs)(redis_jobs)
+        for i in to_fan_out:
+            if i["schedules"]:
+                # a due occurrence: fanned out by the queue's consumers, where the clock's timeout does not apply
+                await cls.put({**i, "schedules": []})
             else:
-                redis_jobs.append(lambda: rescheduling(i))
+                await cls.fan_out(i)
+        dead_letters = await cls.deliver(to_deliver, now_tmp)
+        if dead_letters:
+            await as_async(cls.dead_letters.extend)(dead_letters)
+
+    @classmethod
+    async def deliver(cls, items: List[Dict[str, Any]], now_tmp: float) -> List[Dict[str, Any]]:
+        """ Pushes or emails the items, putting back the failed ones for retrying. Returns the dead letters. """
+        dead_letters = []
+
+        async def pushing(item: Dict[str, Any]) -> List[Dict[str, Any]]:
+            return [await cls.push(item)]
+        to_push = [pushing(i) for i in items if not cls.is_email(i)]
+        to_email = [i for i in items if cls.is_email(i)]
+
+        # emails are split in as many batches as there are pooled SMTP sessions
+        batch_size = -(-len(to_email) // cls.smtp_pool.size)
+        to_push += [cls.push_emails(to_email[n:n + batch_size])
+                    for n in range(0, len(to_email), batch_size or 1)]
 
         for res in asyncio.as_completed(to_push):
-            response = await res
-            i = response["item"]
-            if cls.has_toretry(response):
-                await as_async(LOGGER.warning)(f"item sending timed out. Retrying soon.")
-                i["retries"] += 1
-                await cls.put(i)
-            else:
-                LOGGER.warning(
-                    f"Dropping notification {i['notification']} after 3 unsuccessful retries: {i}")
+            for response in await res:
+                if response["status_code"] == 200:
+                    continue
+                i = response["item"]
+                # retrying this occurrence only: the remaining schedules stay with the scheduled item
+                attempt = {"at": now_tmp, "status_code": response["status_code"], "error": response.get("error")}
+                failed = {**i, "schedules": [], "attempts": [*i.get("attempts", []), attempt]}
+                if cls.has_toretry(response):
+                    await as_async(LOGGER.warning)(f"item sending failed. Retrying soon.")
+                    failed["retries"] += 1
+                    await cls.put(failed)
+                else:
+                    await as_async(LOGGER.warning)(
+                        f"Dead-lettering notification {i['notification']} after {cls.max_retries} unsuccessful retries: {i}")
+                    dead_letters.append({
+                        "item": failed, "error": attempt["error"] or f"status code {attempt['status_code']}", "dead_at": now_tmp})
+        return dead_letters
 
-        await as_async(run_redis_jobs)(redis_jobs)
+    @classmethod
+    async def fan_out(cls, item: Dict[str, Any]) -> None:
+        """ 
+        Puts a copy of the item into the process queue for each subscriber of its topic, reading 'fanout_batch_size' destinations at a time.
+        The copies are standalone: they are delivered, retried and dead-lettered on their own, under an id suffixed with the subscriber's.
+        """
+        cursor = 0
+        while True:
+            cursor, destinations = await as_async(cls.topic_page)(item["topic"], cursor)
+            copies = [{**item, "id": f"{item['id']}:{subscriber}", "topic": None, "schedules": [],
+                       "notification": {**item["notification"], **destination}} for subscriber, destination in destinations.items()]
+            for copy in copies:
+                await cls.put(copy, item.get("priority"))
+            if not cursor:
+                return
+
+    @staticmethod
+    def topic_key(topic: str) -> str:
+        return f"topic_{topic}_subscribers"
+
+    @classmethod
+    def topic_page(cls, topic: str, cursor: int = 0) -> Tuple[int, Dict[str, Dict[str, Any]]]:
+        """ One page of the topic's subscribers and their destinations, along with the cursor to the next page (0 when done). """
+        with RedisPool() as conn:
+            cursor, page = conn.hscan(cls.topic_key(topic), cursor, count=cls.fanout_batch_size)
+        return cursor, {k.decode("utf-8"): json.loads(v) for k, v in page.items()}
 
     @classmethod
-    async def poll_due(cls, sync: bool) -> List[Dict[Any, str]]:
+    async def subscribe_to_topic(cls, subscription: TopicSubscription) -> None:
+        def subscribing() -> None:
+            with RedisPool() as conn:
+                conn.hset(cls.topic_key(subscription.topic), subscription.subscriber_id,
+                          json.dumps(subscription.destination.dict(exclude_none=True)))
+            cls.subscribed_pushees.add(subscription.subscriber_id)
+        await as_async(subscribing)()
+
+    @classmethod
+    async def unsubscribe_from_topic(cls, topic: str, subscriber_id: str) -> bool:
+        def unsubscribing() -> bool:
+            with RedisPool() as conn:
+                return bool(conn.hdel(cls.topic_key(topic), subscriber_id))
+        return await as_async(unsubscribing)()
+
+    @classmethod
+    async def subscribe_poller(cls, poller_id: str) -> None:
+        """ Gives the poller a persistent cursor, starting after the last item currently due. """
+        def subscribing() -> None:
+            cls.subscribed_pollers.add(poller_id)
+            cls.due_for_polling_notifications.subscribe(poller_id)
+        await as_async(subscribing)()
+
+    @classmethod
+    async def unsubscribe_poller(cls, poller_id: str) -> None:
+        def unsubscribing() -> None:
+            cls.subscribed_pollers.discard(poller_id)
+            cls.due_for_polling_notifications.unsubscribe(poller_id)
+        await as_async(unsubscribing)()
+
+    @classmethod
+    async def poll_due(cls, sync: bool, timeout: Optional[float] = None, poller_id: Optional[str] = None) -> List[Dict[Any, str]]:
         """ 
-        Exposes all due schedulables for pollings. When 'sync' is true, performs a destructive sync in the sense that
-        all polled items are deleted forever. Else the due schedulables are polled and stay there.
+        Exposes the due schedulables for polling, oldest first. Subscribed pollers get only the items after their cursor;
+        when 'sync' is true, their cursor moves past the polled items, which are trimmed once all subscribers have polled them.
+        Anonymous pollers get all the items retained so far.
+        With a 'timeout', long-polls: when nothing is there to be polled, waits until something becomes due or the timeout expires.
         """
-        if not sync or not cls.due_last_poll:
-            return list(cls.due_for_polling_notifications)
-
-        def drop_condition(
-            item): return item["notification"]["dispatched"] < cls.due_last_poll
-        def take_condition(
-            item): return item["notification"]["dispatched"] > cls.due_last_poll
-        slice = list(dropwhile_takeif(
-            cls.due_for_polling_notifications, drop_condition, take_condition))
-        redis_jobs = [cls.due_for_polling_notifications.pop for _ in slice]
-        await as_async(run_redis_jobs)(redis_jobs)
-        cls.due_last_poll = datetime.now().timestamp()
-        return slice
+        if not timeout:
+            return await cls.poll_due_now(sync, poller_id)
+        deadline = datetime.now().timestamp() + timeout
+        while True:
+            waiter = cls.due_signal.waiter()
+            polled = await cls.poll_due_now(sync, poller_id)
+            remaining = deadline - datetime.now().timestamp()
+            if polled or remaining <= 0:
+                cls.due_signal.waiters.discard(waiter)
+                return polled
+            await cls.due_signal.wait(waiter, remaining)
+
+    @classmethod
+    async def poll_due_now(cls, sync: bool, poller_id: Optional[str] = None) -> List[Dict[Any, str]]:
+        if not poller_id:
+            entries = await as_async(cls.due_for_polling_notifications.read)()
+        else:
+            entries = await as_async(cls.due_for_polling_notifications.read_for)(poller_id, sync)
+        return [item for _, item in entries]
+
+    @classmethod
+    async def stream_due(cls, last_id: Optional[str] = None, keepalive: int = 15) -> AsyncGenerator[str, None]:
+        """ 
+        Server-Sent Events: pushes the items as they become due, with a comment line as keepalive.
+        Events carry their stream id, so that reconnecting clients resume after the 'Last-Event-ID' they send back.
+        """
+        last = last_id or await as_async(cls.due_for_polling_notifications.last_id)()
+        waiter = None
+        try:
+            while True:
+                waiter = cls.due_signal.waiter()
+                fresh = await as_async(cls.due_for_polling_notifications.read)(last)
+                for _id, item in fresh:
+                    yield f"id: {_id}\ndata: {json.dumps(item)}\n\n"
+                    last = _id
+                if not await cls.due_signal.wait(waiter, keepalive):
+                    yield ": keepalive\n\n"
+        finally:
+            # clients disconnecting while an event is being yielded leave their waiter registered otherwise
+            if waiter:
+                cls.due_signal.waiters.discard(waiter)
+
+    @classmethod
+    async def list_dead_letters(cls, after: Optional[str] = None, limit: int = 50) -> List[Dict[str, Any]]:
+        """ Pages through the dead letters, oldest first. Pass the id of the last entry of a page as 'after' to get the next one. """
+        entries = await as_async(cls.dead_letters.read)(after or "0-0", limit)
+        return [{"id": _id, **letter} for _id, letter in entries]
+
+    @classmethod
+    async def replay_dead_letters(cls, limit: int = 100, rate: float = 10) -> int:
+        """ 
+        Puts back into the queue up to 'limit' dead letters, oldest first, at most 'rate' per second
+        so as not to flood an endpoint that just recovered. Replayed letters get a fresh set of retries.
+        Each letter is claimed by deleting it before being put back, so that overlapping replays never put it twice.
+        """
+        entries = await as_async(cls.dead_letters.read)("0-0", limit)
+        replayed = 0
+        for _id, letter in entries:
+            if not await as_async(cls.dead_letters.delete)([_id]):
+                continue
+            await cls.put({**letter["item"], "retries": 0}, lane="bulk")
+            replayed += 1
+            await asyncio.sleep(1 / rate)
+        await as_async(LOGGER.info)(f"Replayed {replayed} dead letters.")
+        return replayed
 
     @staticmethod
     async def push(item: Dict[str, Any], testing: bool = True) -> Dict[str, Any]:
-        """ Sends a dispatched dispatchable to its final destination. """
+        """ Sends a dispatched dispatchable to its final destination. Errors are reported in the response rather than raised. """
         if not testing:
-            if data := item["requests_options"]["data"]:
-                async with Req(item["requests_options"]["url"], json=data) as response:
-                    return {"status": response.status, "item": item}
+            try:
+                if data := item["requests_options"]["data"]:
+                    async with Req(item["requests_options"]["url"], json=data) as response:
+                        return {"status_code": response.status, "item": item}
+            except Exception as error:
+                return {"status_code": None, "error": repr(error), "item": item}
         return {"status_code": 200, "item": item}
 
+    @classmethod
+    async def push_emails(cls, items: List[Dict[str, Any]], testing: bool = True) -> List[Dict[str, Any]]:
+        """ Sends the email notifications as a single batch over one of the pooled SMTP sessions. """
+        if testing:
+            return [{"status_code": 200, "item": i} for i in items]
+        messages = [cls.smtp_pool.make_message(
+            i["notification"]["email_address"], i["notification"]["email_object"], i["notification"]["body"]) for i in items]
+        try:
+            errors = await cls.smtp_pool.send(messages)
+        except Exception as error:
+            errors = [repr(error)] * len(items)
+        return [{"status_code": None, "error": e, "item": i} if e else {"status_code": 200, "item": i} for i, e in zip(items, errors)]
+
     @staticmethod
-    def has_toretry(response: Dict[str, Any]) -> bool:
-        return response["status_code"] != 200 and response["item"]["retries"] < 3
+    def is_email(item: Dict[str, Any]) -> bool:
+        """ Email notifications are told apart by their address, as the notification type does not survive serialization. """
+        return bool(item["notification"].get("email_address"))
+
+    @classmethod
+    def has_toretry(cls, response: Dict[str, Any]) -> bool:
+        return response["status_code"] != 200 and response["item"]["retries"] < cls.max_retries
 
 
 @app.get(f"/{__MODULE_NAME__}/poll_due/")
-async def poll_due(sync: Optional[bool] = None) -> QueryResponse:
+async def poll_due(poller_id: Optional[str] = None, sync: Optional[bool] = None, timeout: Optional[int] = None) -> QueryResponse:
+    query = Query(service=__MODULE_NAME__)
+    if poller_id and not poller_id in Dispatcher.subscribed_pollers:
+        return QueryResponse(query=query, error=f"Unknown poller {poller_id}, please subscribe first.")
+    results = await Dispatcher.poll_due(True if sync is None else sync, min(timeout, 60) if timeout else None, poller_id)
+    return QueryResponse(query=query, results_count=len(results), results=results)
+
+
+@app.post(f"/{__MODULE_NAME__}/subscribe_poller/")
+async def subscribe_poller(poller_id: str) -> QueryResponse:
+    query = Query(service=__MODULE_NAME__)
+    await Dispatcher.subscribe_poller(poller_id)
+    return QueryResponse(query=query, message=f"Subscribed {poller_id}")
+
+
+@app.post(f"/{__MODULE_NAME__}/unsubscribe_poller/")
+async def unsubscribe_poller(poller_id: str) -> QueryResponse:
     query = Query(service=__MODULE_NAME__)
-    results = await Dispatcher.poll_due(True if sync is None else sync)
+    await Dispatcher.unsubscribe_poller(poller_id)
+    return QueryResponse(query=query, message=f"Unsubscribed {poller_id}")
+
+
+@app.post(f"/{__MODULE_NAME__}/subscribe_topic/")
+async def subscribe_topic(subscription: TopicSubscription) -> QueryResponse:
+    query = Query(service=__MODULE_NAME__)
+    await Dispatcher.subscribe_to_topic(subscription)
+    return QueryResponse(query=query, message=f"Subscribed {subscription.subscriber_id} to {subscription.topic}")
+
+
+@app.post(f"/{__MODULE_NAME__}/unsubscribe_topic/")
+async def unsubscribe_topic(topic: str, subscriber_id: str) -> QueryResponse:
+    query = Query(service=__MODULE_NAME__)
+    if await Dispatcher.unsubscribe_from_topic(topic, subscriber_id):
+        return QueryResponse(query=query, message=f"Unsubscribed {subscriber_id} from {topic}")
+    return QueryResponse(query=query, error=f"{subscriber_id} is not subscribed to {topic}")
+
+
+@app.get(f"/{__MODULE_NAME__}/dead_letters/")
+async def get_dead_letters(after: Optional[str] = None, limit: int = 50) -> QueryResponse:
+    query = Query(service=__MODULE_NAME__)
+    results = await Dispatcher.list_dead_letters(after, min(limit, 500))
     return QueryResponse(query=query, results_count=len(results), results=results)
+
+
+@app.post(f"/{__MODULE_NAME__}/replay_dead_letters/")
+async def replay_dead_letters(limit: int = 100, rate: float = 10) -> QueryResponse:
+    query = Query(service=__MODULE_NAME__)
+    if rate <= 0:
+        return QueryResponse(query=query, error="The replay rate must be positive.")
+    if (running := Dispatcher.running_workers.get("replay")) and not running.done():
+        return QueryResponse(query=query, error="A replay is running already, please retry once it is over.")
+    # replaying runs in the background, as throttling makes it outlast the request
+    Dispatcher.running_workers["replay"] = asyncio.create_task(
+        Dispatcher.replay_dead_letters(limit, rate))
+    return QueryResponse(query=query, message=f"Replaying up to {limit} dead letters at {rate} per second.")
+
+
+@app.get(f"/{__MODULE_NAME__}/stream_due/")
+async def stream_due(last_event_id: Optional[str] = Header(None)) -> StreamingResponse:
+    return StreamingResponse(Dispatcher.stream_due(last_event_id), media_type="text/event-stream")
@@ -0,0 +1,92 @@
+# Defrag - centralized API for the openSUSE Infrastructure
+# Copyright (C) 2021 openSUSE contributors.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+from defrag.modules.db.redis import RedisPool
+from threading import Event
+from typing import Callable, Optional, Set
+import asyncio
+
+
+class RedisBroadcast:
+    """
+    Wakes up the coroutines waiting in this process whenever any replica publishes on 'channel'.
+    Waiters should be registered *before* checking for the condition they wait for, so that
+    a publication landing in between is not missed.
+    """
+
+    def __init__(self, channel: str) -> None:
+        self.channel = channel
+        self.waiters: Set[asyncio.Event] = set()
+        # one stop flag per running 'listen', so that closing stops these listeners only, not those started afterwards
+        self.stops: Set[Event] = set()
+
+    def publish(self) -> None:
+        with RedisPool() as conn:
+            conn.publish(self.channel, "1")
+
+    def notify(self) -> None:
+        for event in self.waiters:
+            event.set()
+
+    def waiter(self) -> asyncio.Event:
+        event = asyncio.Event()
+        self.waiters.add(event)
+        return event
+
+    async def wait(self, event: asyncio.Event, timeout: float) -> bool:
+        """ Returns whether something was published before the timeout expired. """
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.waiters.discard(event)
+
+    async def listen(self, relay: Optional[Callable[[bytes], None]] = None, subscribed: Optional[Callable[[], None]] = None) -> None:
+        """ 
+        Relays the publications into the event loop, from a thread blocking on the subscription: their payloads are passed to 
+        'relay' in the order they were published if set, else the waiters are woken up. 'subscribed' is called once subscribed.
+        The thread stops within a second of 'close' being called, or of the listening task being cancelled.
+        """
+        loop = asyncio.get_running_loop()
+        stop = Event()
+        self.stops.add(stop)
+
+        def listening() -> None:
+            with RedisPool() as conn:
+                pubsub = conn.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.channel)
+                if subscribed:
+                    loop.call_soon_threadsafe(subscribed)
+                try:
+                    while not stop.is_set():
+                        if message := pubsub.get_message(timeout=1.0):
+                            if relay:
+                                loop.call_soon_threadsafe(relay, message["data"])
+                            else:
+                                loop.call_soon_threadsafe(self.notify)
+                finally:
+                    pubsub.close()
+        try:
+            await loop.run_in_executor(None, listening)
+        finally:
+            stop.set()
+            self.stops.discard(stop)
+
+    def close(self) -> None:
+        for stop in self.stops:
+            stop.set()
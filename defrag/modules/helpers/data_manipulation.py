@@ -15,8 +15,10 @@
 # along with this program. If not, see <https://www.gnu.org/licenses/>.
 
 from functools import reduce
+from hashlib import blake2b
 from itertools import dropwhile
 from typing import Any, Callable, Generator, Iterable, List, Tuple
+import json
 
 """
 Some utilities for doing data manipulation.
@@ -94,4 +96,10 @@ def dropwhile_takeif(it: Iterable, drop_condition: Callable[[Any], bool], take_c
     def keep(x): return take_condition(x)
     for item in dropwhile(drop, it):
         if keep(item):
-            yield item
\ No newline at end of file
+            yield item
+
+
+def stable_digest(value: Any, digest_size: int = 16) -> str:
+    """ Digest of a JSON-serializable value over its canonical serialization. Unlike 'hash', it is the same across processes and restarts. """
+    canonical = json.dumps(value, sort_keys=True, separators=(",", ":"), default=str)
+    return blake2b(canonical.encode("utf-8"), digest_size=digest_size).hexdigest()
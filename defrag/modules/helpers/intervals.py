@@ -0,0 +1,292 @@
+# Defrag - centralized API for the openSUSE Infrastructure
+# Copyright (C) 2021 openSUSE contributors.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+from defrag.modules.db.redis import RedisPool
+from defrag.modules.helpers.broadcast import RedisBroadcast
+from redis.client import Pipeline
+from threading import Lock
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+import asyncio
+
+
+class IntervalIndex:
+    """
+    In-memory index of [start, end] intervals (timestamps) keyed by id, answering overlap queries in O(log(n) + k).
+    Intervals are kept sorted by start, along with the longest duration seen: an interval overlapping [lo, hi]
+    must start within [lo - longest duration, hi], which bounds the candidates to check against their end.
+    Intervals without an end (infinite 'end') are kept aside, so as not to make 'longest' infinite.
+    """
+
+    def __init__(self) -> None:
+        self.starts: List[Tuple[float, str]] = []
+        self.spans: Dict[str, Tuple[float, float]] = {}
+        self.unbounded: Dict[str, float] = {}
+        self.longest: float = 0
+
+    def __len__(self) -> int:
+        return len(self.spans)
+
+    def __contains__(self, _id: str) -> bool:
+        return _id in self.spans
+
+    def add(self, _id: str, start: float, end: float) -> None:
+        if _id in self.spans:
+            self.remove(_id)
+        self.spans[_id] = (start, end)
+        if end == float("inf"):
+            self.unbounded[_id] = start
+            return
+        insort(self.starts, (start, _id))
+        self.longest = max(self.longest, end - start)
+
+    def update(self, spans: Iterable[Tuple[str, float, float]]) -> None:
+        for _id, start, end in spans:
+            self.add(_id, start, end)
+
+    def remove(self, _id: str) -> None:
+        if not _id in self.spans:
+            return
+        start, _ = self.spans.pop(_id)
+        if self.unbounded.pop(_id, None) is None:
+            self.starts.pop(bisect_left(self.starts, (start, _id)))
+
+    def overlapping(self, lo: float, hi: float) -> List[str]:
+        """ Ids of the intervals overlapping [lo, hi], by ascending start. """
+        first = bisect_left(self.starts, (lo - self.longest, ""))
+        last = bisect_right(self.starts, (hi, chr(0x10ffff)))
+        found = [(start, _id) for start, _id in self.starts[first:last] if self.spans[_id][1] >= lo]
+        if self.unbounded:
+            found = sorted(found + [(start, _id) for _id, start in self.unbounded.items() if start <= hi])
+        return [_id for _, _id in found]
+
+
+class RedisIntervalIndex:
+    """
+    The same index, shared by all workers in Redis: the starts in a sorted set (open-ended intervals in another one),
+    the ends in a hash and the durations in a sorted set, whose top is the longest duration.
+    Writes are queued into the caller's pipeline, a MULTI/EXEC transaction, so as to be atomic with the caller's own writes.
+    Queries run as a single script, unless the worker keeps a local mirror of the index (see 'mirror').
+    """
+
+    OVERLAPPING = """
+    local lo, hi = tonumber(ARGV[1]), tonumber(ARGV[2])
+    local longest = tonumber(redis.call('ZREVRANGE', KEYS[3], 0, 0, 'WITHSCORES')[2] or 0)
+    local candidates = redis.call('ZRANGEBYSCORE', KEYS[1], lo - longest, hi, 'WITHSCORES')
+    local found = {}
+    for n = 1, #candidates, 2000 do
+        local batch = {}
+        for m = n, math.min(n + 1999, #candidates), 2 do
+            table.insert(batch, candidates[m])
+        end
+        local ends = redis.call('HMGET', KEYS[2], unpack(batch))
+        for m, _id in ipairs(batch) do
+            if tonumber(ends[m]) >= lo then
+                table.insert(found, _id)
+                table.insert(found, candidates[n + 2 * (m - 1) + 1])
+            end
+        end
+    end
+    local unbounded = redis.call('ZRANGEBYSCORE', KEYS[4], '-inf', hi, 'WITHSCORES')
+    for n = 1, #unbounded do
+        table.insert(found, unbounded[n])
+    end
+    return found
+    """
+
+    def __init__(self, key: str) -> None:
+        self.starts_key = f"{key}_starts"
+        self.ends_key = f"{key}_ends"
+        self.durations_key = f"{key}_durations"
+        self.unbounded_key = f"{key}_unbounded"
+        # the ids written to are published there, along with the writes
+        self.changes = RedisBroadcast(f"{key}_changes")
+        self.overlapping_script = RedisPool().connection.register_script(self.OVERLAPPING)
+        # local mirror, if any, whether it is yet to be loaded, and the ids written to since it was last refreshed
+        self.local: Optional[IntervalIndex] = None
+        self.stale = True
+        self.changed: Set[str] = set()
+        # queries run in the executor's threads
+        self.lock = Lock()
+
+    def keys(self) -> List[str]:
+        return [self.starts_key, self.ends_key, self.durations_key, self.unbounded_key]
+
+    def add(self, pipe: Pipeline, _id: str, start: float, end: float) -> None:
+        if end == float("inf"):
+            pipe.zrem(self.starts_key, _id)
+            pipe.zrem(self.durations_key, _id)
+            pipe.zadd(self.unbounded_key, {_id: start})
+        else:
+            pipe.zrem(self.unbounded_key, _id)
+            pipe.zadd(self.starts_key, {_id: start})
+            pipe.zadd(self.durations_key, {_id: end - start})
+        pipe.hset(self.ends_key, _id, repr(end))
+        pipe.publish(self.changes.channel, _id)
+
+    def remove(self, pipe: Pipeline, _id: str) -> None:
+        for key in [self.starts_key, self.durations_key, self.unbounded_key]:
+            pipe.zrem(key, _id)
+        pipe.hdel(self.ends_key, _id)
+        pipe.publish(self.changes.channel, _id)
+
+    def contains(self, ids: List[str]) -> List[bool]:
+        with RedisPool(pipeline=True) as pipe:
+            for _id in ids:
+                pipe.hexists(self.ends_key, _id)
+            return pipe.execute()
+
+    def __len__(self) -> int:
+        with RedisPool() as conn:
+            return conn.hlen(self.ends_key)
+
+    def load(self) -> IntervalIndex:
+        with RedisPool(pipeline=True) as pipe:
+            pipe.zrange(self.starts_key, 0, -1, withscores=True)
+            pipe.zrange(self.unbounded_key, 0, -1, withscores=True)
+            pipe.hgetall(self.ends_key)
+            starts, unbounded, ends = pipe.execute()
+        index = IntervalIndex()
+        index.update((_id.decode("utf-8"), start, float(ends[_id])) for _id, start in starts + unbounded if _id in ends)
+        return index
+
+    def refresh(self, local: IntervalIndex, ids: Iterable[str]) -> None:
+        """ Reads the intervals of 'ids' again into the local mirror, dropping those removed since. """
+        ids = list(ids)
+        with RedisPool(pipeline=True) as pipe:
+            for _id in ids:
+                pipe.zscore(self.starts_key, _id)
+                pipe.zscore(self.unbounded_key, _id)
+                pipe.hget(self.ends_key, _id)
+            values = pipe.execute()
+        for _id, start, unbounded_start, end in zip(ids, values[0::3], values[1::3], values[2::3]):
+            if end is None or (start is None and unbounded_start is None):
+                local.remove(_id)
+            else:
+                local.add(_id, start if start is not None else unbounded_start, float(end))
+
+    def overlapping(self, lo: float, hi: float) -> List[str]:
+        """ Ids of the intervals overlapping [lo, hi], by ascending start. """
+        with self.lock:
+            if self.local is not None:
+                # taken first, so that the ids written to while reading are refreshed by the next query
+                changed, self.changed = self.changed, set()
+                if self.stale:
+                    self.stale = False
+                    self.local = self.load()
+                elif changed:
+                    self.refresh(self.local, changed)
+                return self.local.overlapping(lo, hi)
+        found = self.overlapping_script(keys=self.keys(), args=[lo, hi])
+        pairs = sorted((float(start), _id.decode("utf-8")) for _id, start in zip(found[0::2], found[1::2]))
+        return [_id for _, _id in pairs]
+
+    async def mirror(self) -> None:
+        """ 
+        Keeps a local copy of the index, loaded by the first query once subscribed to the ids written to, after which 
+        queries only read the intervals of the ids written to since the previous query again. Stops mirroring when cancelled.
+        """
+        subscribed = asyncio.Event()
+        listener = asyncio.create_task(self.changes.listen(
+            relay=lambda _id: self.changed.add(_id.decode("utf-8")), subscribed=subscribed.set))
+        try:
+            await subscribed.wait()
+            with self.lock:
+                self.stale, self.local = True, IntervalIndex()
+            await listener
+        finally:
+            self.changes.close()
+            listener.cancel()
+            with self.lock:
+                self.local = None
+
+
+class WindowCache:
+    """
+    Per-worker, in-memory cache of values computed over [lo, hi] windows (e.g. rendered views of a calendar), 
+    invalidated precisely rather than wholesale. Writers log the span of whatever they change (see 'changing') under a sequence 
+    number shared by all workers. Before each lookup, a worker evicts the windows overlapping the spans logged since its last lookup, 
+    found through an IntervalIndex of its windows. Only the last 'log_size' spans are kept: a worker lagging further behind drops all its windows.
+    """
+
+    LOG = """
+    local seq = redis.call('INCR', KEYS[1])
+    redis.call('ZADD', KEYS[2], seq, seq .. ':' .. ARGV[1] .. ':' .. ARGV[2])
+    redis.call('ZREMRANGEBYRANK', KEYS[2], 0, -tonumber(ARGV[3]) - 1)
+    return seq
+    """
+
+    def __init__(self, key: str, max_windows: int = 256, log_size: int = 1000) -> None:
+        self.seq_key = f"{key}_seq"
+        self.log_key = f"{key}_log"
+        self.max_windows = max_windows
+        self.log_size = log_size
+        self.log_script = RedisPool().connection.register_script(self.LOG)
+        # least recently used first
+        self.windows: "OrderedDict[str, Any]" = OrderedDict()
+        self.index = IntervalIndex()
+        # the last sequence number seen, None until the first lookup
+        self.seq: Optional[int] = None
+        # lookups run in the executor's threads
+        self.lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self.windows)
+
+    def changing(self, pipe: Pipeline, lo: float, hi: float) -> None:
+        """ Queues the logging of a change over [lo, hi] into the caller's pipeline, along with the change itself. """
+        self.log_script(keys=[self.seq_key, self.log_key], args=[repr(lo), repr(hi), self.log_size], client=pipe)
+
+    def sync(self) -> None:
+        """ Evicts the windows overlapping the spans changed since the last sync. """
+        with RedisPool() as conn:
+            seq = int(conn.get(self.seq_key) or 0)
+            if seq == self.seq:
+                return
+            changes = conn.zrangebyscore(self.log_key, f"({self.seq}", seq) if self.seq is not None and seq > self.seq else []
+        with self.lock:
+            # fallen behind the log, or the log was reset
+            if self.seq is None or seq < self.seq or len(changes) < seq - self.seq:
+                self.windows.clear()
+                self.index = IntervalIndex()
+            else:
+                for change in changes:
+                    _, lo, hi = change.decode("utf-8").split(":")
+                    for key in self.index.overlapping(float(lo), float(hi)):
+                        self.evict(key)
+            self.seq = seq
+
+    def evict(self, key: str) -> None:
+        self.windows.pop(key, None)
+        self.index.remove(key)
+
+    def get(self, key: str) -> Optional[Any]:
+        self.sync()
+        with self.lock:
+            if not key in self.windows:
+                return None
+            self.windows.move_to_end(key)
+            return self.windows[key]
+
+    def put(self, key: str, lo: float, hi: float, value: Any) -> None:
+        """ To be called after 'get' missed, so that changes landing while computing the value evict it on the next lookup. """
+        with self.lock:
+            self.windows[key] = value
+            self.windows.move_to_end(key)
+            self.index.add(key, lo, hi)
+            while len(self.windows) > self.max_windows:
+                self.evict(next(iter(self.windows)))
@@ -0,0 +1,151 @@
+# Defrag - centralized API for the openSUSE Infrastructure
+# Copyright (C) 2021 openSUSE contributors.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+from asyncio.tasks import Task
+from defrag import LOGGER
+from defrag.modules.db.redis import RedisPool
+from defrag.modules.helpers.sync_utils import as_async
+from typing import Callable, Coroutine, Dict, Optional
+from uuid import uuid4
+import asyncio
+import os
+import socket
+
+"""
+Leader election on top of a Redis lease lock, so that jobs which must run exactly once across
+the fleet (the Dispatcher clock, the services monitor...) run on a single replica while the others stand by.
+"""
+
+
+class LeaseLock:
+    """
+    A lock that expires after 'ttl_ms' unless renewed by its owner. Every successful acquisition
+    draws a new, strictly increasing fencing token: a former owner that was paused past its lease can
+    tell it has been superseded by comparing its token with the current one.
+    """
+
+    ACQUIRE = """
+    if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+        return redis.call('INCR', KEYS[2])
+    end
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        redis.call('PEXPIRE', KEYS[1], ARGV[2])
+        return tonumber(redis.call('GET', KEYS[2]))
+    end
+    return 0
+    """
+    RENEW = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] and redis.call('GET', KEYS[2]) == ARGV[3] then
+        return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+    RELEASE = """
+    if redis.call('GET', KEYS[1]) == ARGV[1] then
+        return redis.call('DEL', KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(self, key: str, ttl_ms: int = 15000, owner: Optional[str] = None) -> None:
+        self.key = key
+        self.fencing_key = f"{key}_fencing_token"
+        self.ttl_ms = ttl_ms
+        self.owner = owner or f"{socket.gethostname()}-{os.getpid()}-{uuid4().hex}"
+        self.token: Optional[int] = None
+
+    def run_script(self, script: str, *args) -> int:
+        with RedisPool() as conn:
+            return conn.eval(script, 2, self.key, self.fencing_key, self.owner, *args)
+
+    def acquire(self) -> bool:
+        if token := self.run_script(self.ACQUIRE, self.ttl_ms):
+            self.token = token
+            return True
+        return False
+
+    def renew(self) -> bool:
+        """ Extends the lease, provided that it is still ours and that nobody acquired it in the meantime. """
+        if self.token is None:
+            return False
+        return bool(self.run_script(self.RENEW, self.ttl_ms, self.token))
+
+    def is_valid(self) -> bool:
+        """ Fencing check, for leaders to run right before doing any work that must not be duplicated. """
+        with RedisPool() as conn:
+            owner, token = conn.mget(self.key, self.fencing_key)
+        return self.token is not None and owner == self.owner.encode("utf-8") and int(token or 0) == self.token
+
+    def release(self) -> None:
+        self.run_script(self.RELEASE)
+        self.token = None
+
+
+class LeaderElection:
+    """
+    Campaigns for the lease every 'renew_interval' seconds. Upon winning it, starts all the 'jobs'; upon losing it
+    (failed renewal, Redis unavailable), cancels them and goes back to standing by.
+    While leading, restarts the jobs that died of an error, so that a crashed job does not go unnoticed behind a renewed lease.
+    """
+
+    def __init__(self, lock: LeaseLock, jobs: Dict[str, Callable[[], Coroutine]], renew_interval: Optional[float] = None) -> None:
+        self.lock = lock
+        self.jobs = jobs
+        self.renew_interval = renew_interval or lock.ttl_ms / 3000
+        self.running_jobs: Dict[str, Task] = {}
+        self.is_leader = False
+
+    async def campaign(self) -> None:
+        while True:
+            try:
+                if self.is_leader and not await as_async(self.lock.renew)():
+                    await as_async(LOGGER.warning)(f"Lost the lease on {self.lock.key}, standing by.")
+                    self.step_down()
+                elif not self.is_leader and await as_async(self.lock.acquire)():
+                    await as_async(LOGGER.info)(f"Acquired the lease on {self.lock.key} with token {self.lock.token}.")
+                    self.step_up()
+                if self.is_leader:
+                    for name, error in self.revive().items():
+                        await as_async(LOGGER.error)(f"Leader job {name} died ({error!r}), restarted it.")
+            except Exception as error:
+                await as_async(LOGGER.error)(f"Leader election on {self.lock.key} failed: {error}")
+                self.step_down()
+            await asyncio.sleep(self.renew_interval)
+
+    async def validate(self) -> bool:
+        return self.is_leader and await as_async(self.lock.is_valid)()
+
+    def step_up(self) -> None:
+        self.is_leader = True
+        for name, job in self.jobs.items():
+            self.running_jobs[name] = asyncio.create_task(job())
+
+    def revive(self) -> Dict[str, BaseException]:
+        """ Restarts the jobs that died of an error, returning these errors by job name. Jobs that returned stay done. """
+        died = {name: t.exception() for name, t in self.running_jobs.items() if t.done() and not t.cancelled() and t.exception()}
+        for name in died:
+            self.running_jobs[name] = asyncio.create_task(self.jobs[name]())
+        return died
+
+    def step_down(self) -> None:
+        for t in self.running_jobs.values():
+            t.cancel()
+        self.running_jobs = {}
+        self.is_leader = False
+
+    def resign(self) -> None:
+        self.step_down()
+        self.lock.release()
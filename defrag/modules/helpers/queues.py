@@ -0,0 +1,183 @@
+# Defrag - centralized API for the openSUSE Infrastructure
+# Copyright (C) 2021 openSUSE contributors.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+from collections import deque
+from defrag.modules.db.redis import RedisPool
+from defrag.modules.helpers.sync_utils import as_async
+from itertools import cycle
+from redis.exceptions import ResponseError
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+import asyncio
+import json
+import os
+import socket
+
+"""
+Queue backends for the Dispatcher. All of them expose the same three coroutines:
+- 'put' enqueues an item into one of the priority lanes,
+- 'get' returns a (receipt, item) pair, blocking until an item is available,
+- 'ack' acknowledges the receipt once the item has been fully processed.
+Lanes are consumed by weighted round-robin, so that a burst in a low-priority lane
+only delays the higher-priority lanes by a few items.
+"""
+
+# lane name -> weight, i.e. how many items are taken from the lane per round
+LANES: Dict[str, int] = {"immediate": 5, "reminder": 3, "bulk": 1}
+
+Receipt = Optional[Tuple[str, str]]
+
+START = "0-0"
+
+
+def weighted_rounds(lanes: Dict[str, int]) -> Iterator[str]:
+    return cycle([name for name, weight in lanes.items() for _ in range(weight)])
+
+
+class MemoryQueue:
+    """ In-process queue: fast, but lost on crash and only visible to the current process. """
+
+    def __init__(self, lanes: Dict[str, int] = LANES) -> None:
+        self.lanes: Dict[str, Deque[Dict[str, Any]]] = {
+            name: deque() for name in lanes}
+        self.rounds = weighted_rounds(lanes)
+        # counts the items across all lanes
+        self.available = asyncio.Semaphore(0)
+
+    async def put(self, item: Dict[str, Any], lane: str) -> None:
+        self.lanes[lane].append(item)
+        self.available.release()
+
+    async def get(self) -> Tuple[Receipt, Dict[str, Any]]:
+        await self.available.acquire()
+        for name in self.rounds:
+            if self.lanes[name]:
+                return None, self.lanes[name].popleft()
+
+    async def ack(self, receipt: Receipt) -> None:
+        pass
+
+
+class RedisStreamQueue:
+    """
+    Durable queue backed by one Redis Stream per lane, read through a consumer group, so that several replicas can share
+    the work with at-least-once delivery. Entries are acknowledged (XACK) only after they have been processed.
+    Entries left pending for more than 'claim_idle_ms', by a consumer that died or that failed to process them, are reclaimed
+    (XAUTOCLAIM) by whichever consumer asks for work next.
+    """
+
+    def __init__(
+        self,
+        key: str = "dispatcher_stream",
+        group: str = "dispatchers",
+        consumer: Optional[str] = None,
+        lanes: Dict[str, int] = LANES,
+        block_ms: int = 5000,
+        claim_idle_ms: int = 60000,
+        maxlen: int = 100000
+    ) -> None:
+        self.key = key
+        self.group = group
+        self.consumer = consumer or f"{socket.gethostname()}-{os.getpid()}"
+        self.lanes = lanes
+        self.streams = {name: f"{key}_{name}" for name in lanes}
+        self.rounds = weighted_rounds(lanes)
+        self.block_ms = block_ms
+        self.claim_idle_ms = claim_idle_ms
+        self.maxlen = maxlen
+        self.buffers: Dict[str, Deque[Tuple[Receipt, Dict[str, Any]]]] = {
+            name: deque() for name in lanes}
+        # where each lane's scan of its pending entries resumes, see 'reclaim'
+        self.claim_cursors = {name: START for name in lanes}
+
+    def ensure_groups(self) -> None:
+        with RedisPool() as conn:
+            for stream in self.streams.values():
+                try:
+                    conn.xgroup_create(stream, self.group, id="0", mkstream=True)
+                except ResponseError as error:
+                    if not "BUSYGROUP" in str(error):
+                        raise
+
+    @staticmethod
+    def decode(stream: str, entries: List[Tuple[bytes, Dict[bytes, bytes]]]) -> List[Tuple[Receipt, Dict[str, Any]]]:
+        return [((stream, _id.decode("utf-8")), json.loads(fields[b"item"])) for _id, fields in entries if fields]
+
+    def reclaim(self, name: str) -> List[Tuple[Receipt, Dict[str, Any]]]:
+        """ 
+        Takes over the entries pending for too long, this consumer's own included (these failed processing). 
+        The scan goes on from a cursor across calls, so that entries stuck at the head of the pending list cannot hide the others.
+        """
+        stream = self.streams[name]
+        with RedisPool() as conn:
+            # redis-py does not wrap XAUTOCLAIM, whose reply is [cursor, entries] (plus the deleted ids as of Redis 7)
+            cursor, entries, *_ = conn.execute_command(
+                "XAUTOCLAIM", stream, self.group, self.consumer, self.claim_idle_ms, self.claim_cursors[name], "COUNT", self.lanes[name])
+        self.claim_cursors[name] = cursor.decode("utf-8")
+        return self.decode(stream, [(_id, dict(zip(fields[0::2], fields[1::2]))) for _id, fields in entries if fields])
+
+    def fetch(self) -> bool:
+        """
+        Fills the lane buffers with at most 'weight' entries per lane, pending entries first. 
+        Only when all lanes are empty, waits for new entries for at most 'block_ms'. Returns whether anything was fetched.
+        """
+        try:
+            with RedisPool() as conn:
+                for name, weight in self.lanes.items():
+                    entries = self.reclaim(name)
+                    if not entries:
+                        response = conn.xreadgroup(self.group, self.consumer, {
+                                                   self.streams[name]: ">"}, count=weight)
+                        entries = [e for stream, es in response for e in self.decode(stream.decode("utf-8"), es)]
+                    self.buffers[name].extend(entries)
+                if any(self.buffers.values()):
+                    return True
+                response = conn.xreadgroup(self.group, self.consumer, {
+                                           stream: ">" for stream in self.streams.values()}, count=1, block=self.block_ms)
+            lanes_by_stream = {stream: name for name, stream in self.streams.items()}
+            for stream, entries in response:
+                stream = stream.decode("utf-8")
+                self.buffers[lanes_by_stream[stream]].extend(self.decode(stream, entries))
+            return bool(response)
+        except ResponseError as error:
+            # groups vanish with their streams, e.g. after flushing the database
+            if not "NOGROUP" in str(error):
+                raise
+            self.ensure_groups()
+            return False
+
+    async def put(self, item: Dict[str, Any], lane: str) -> None:
+        def adding() -> None:
+            with RedisPool() as conn:
+                conn.xadd(self.streams[lane], {"item": json.dumps(item)},
+                          maxlen=self.maxlen, approximate=True)
+        await as_async(adding)()
+
+    async def get(self) -> Tuple[Receipt, Dict[str, Any]]:
+        while not any(self.buffers.values()):
+            await as_async(self.fetch)()
+        for name in self.rounds:
+            if self.buffers[name]:
+                return self.buffers[name].popleft()
+
+    async def ack(self, receipt: Receipt) -> None:
+        stream, _id = receipt
+
+        def acknowledging() -> None:
+            with RedisPool(pipeline=True) as pipe:
+                pipe.xack(stream, self.group, _id)
+                pipe.xdel(stream, _id)
+                pipe.execute()
+        await as_async(acknowledging)()
@@ -156,7 +156,7 @@ class ServicesManager:
             tasks: List[Coroutine] = []
             for serv_name, serv in cls.services.items():
                 if strat := serv.template.cache_strategy:
-                    if strat.autorefresh:
+                    if strat.auto_refresh:
                         tasks.append(fetch_then_update(serv_name))
             await asyncio.gather(*tasks)
             cls.monitor_last_run = datetime.now()
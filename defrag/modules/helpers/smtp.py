@@ -0,0 +1,116 @@
+# Defrag - centralized API for the openSUSE Infrastructure
+# Copyright (C) 2021 openSUSE contributors.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+from defrag.modules.helpers.sync_utils import as_async
+from email.message import EmailMessage
+from typing import List, Optional, Tuple
+import asyncio
+import smtplib
+
+
+class SMTPPool:
+    """
+    A pool of 'size' authenticated SMTP sessions, opened lazily and kept open across messages.
+    Each call to 'send' borrows one session and sends its whole batch over it, re-opening the session once
+    if the server dropped it. smtplib being blocking, sessions are driven from the executor's threads.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        user: str = "",
+        password: str = "",
+        sender: str = "",
+        starttls: bool = False,
+        size: int = 4,
+        timeout: int = 10
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.sender = sender
+        self.starttls = starttls
+        self.size = size
+        self.timeout = timeout
+        # created on first use, so as to be bound to the running loop
+        self.sessions: Optional[asyncio.Queue] = None
+
+    def make_message(self, to: str, subject: str, body: str) -> EmailMessage:
+        message = EmailMessage()
+        message["From"] = self.sender
+        message["To"] = to
+        message["Subject"] = subject
+        message.set_content(body)
+        return message
+
+    def connect(self) -> smtplib.SMTP:
+        session = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.starttls:
+            session.starttls()
+        if self.user:
+            session.login(self.user, self.password)
+        return session
+
+    @staticmethod
+    def discard(session: Optional[smtplib.SMTP]) -> None:
+        if session:
+            try:
+                session.close()
+            except Exception:
+                pass
+
+    def sending(self, session: Optional[smtplib.SMTP], messages: List[EmailMessage]) -> Tuple[Optional[smtplib.SMTP], List[Optional[str]]]:
+        """ Returns the session, or None if it is broken, along with one error (or None) per message. """
+        errors: List[Optional[str]] = []
+        for message in messages:
+            for reconnected in [False, True]:
+                try:
+                    session = session or self.connect()
+                    session.send_message(message)
+                    errors.append(None)
+                    break
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError) as error:
+                    # rejected message: smtplib resets the transaction, the session itself is still usable.
+                    # Caught first, as SMTP errors are OSErrors too.
+                    errors.append(repr(error))
+                    break
+                except (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, OSError) as error:
+                    self.discard(session)
+                    session = None
+                    if reconnected:
+                        errors.append(repr(error))
+        return session, errors
+
+    async def send(self, messages: List[EmailMessage]) -> List[Optional[str]]:
+        if self.sessions is None:
+            self.sessions = asyncio.Queue()
+            for _ in range(self.size):
+                self.sessions.put_nowait(None)
+        session = await self.sessions.get()
+        try:
+            session, errors = await as_async(self.sending)(session, messages)
+        finally:
+            self.sessions.put_nowait(session)
+        return errors
+
+    async def close(self) -> None:
+        if self.sessions is None:
+            return
+        while not self.sessions.empty():
+            await as_async(self.discard)(self.sessions.get_nowait())
+        self.sessions = None
@@ -0,0 +1,96 @@
+# Defrag - centralized API for the openSUSE Infrastructure
+# Copyright (C) 2021 openSUSE contributors.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <https://www.gnu.org/licenses/>.
+
+from defrag.modules.db.redis import RedisPool
+from pottery import RedisDict
+from typing import Any, Dict, List, Optional, Tuple
+import json
+
+START = "0-0"
+
+
+class CursoredStream:
+    """
+    Append-only log on a Redis Stream, read by any number of subscribers, each one through its own cursor
+    (the id of the last entry it consumed). Cursors are stored in Redis so that they survive restarts, and
+    entries are trimmed once all cursors have moved past them. 'maxlen' caps the stream when nobody subscribes.
+    """
+
+    def __init__(self, key: str, maxlen: int = 10000) -> None:
+        self.key = key
+        self.maxlen = maxlen
+        self.cursors = RedisDict({}, redis=RedisPool().connection, key=f"{key}_cursors")
+
+    def __len__(self) -> int:
+        with RedisPool() as conn:
+            return conn.xlen(self.key)
+
+    @staticmethod
+    def decode(entries: List[Tuple[bytes, Dict[bytes, bytes]]]) -> List[Tuple[str, Dict[str, Any]]]:
+        return [(_id.decode("utf-8"), json.loads(fields[b"item"])) for _id, fields in entries]
+
+    def append(self, item: Dict[str, Any]) -> str:
+        with RedisPool() as conn:
+            return conn.xadd(self.key, {"item": json.dumps(item)}, maxlen=self.maxlen, approximate=True).decode("utf-8")
+
+    def extend(self, items: List[Dict[str, Any]]) -> None:
+        with RedisPool(pipeline=True) as pipe:
+            for item in items:
+                pipe.xadd(self.key, {"item": json.dumps(item)}, maxlen=self.maxlen, approximate=True)
+            pipe.execute()
+
+    def last_id(self) -> str:
+        with RedisPool() as conn:
+            last = conn.xrevrange(self.key, count=1)
+        return last[0][0].decode("utf-8") if last else START
+
+    def read(self, after: str = START, count: Optional[int] = None) -> List[Tuple[str, Dict[str, Any]]]:
+        """ Entries strictly after the 'after' id, oldest first. O(log(n) + returned entries). """
+        with RedisPool() as conn:
+            response = conn.xread({self.key: after}, count=count)
+        return [entry for _, entries in response for entry in self.decode(entries)]
+
+    def delete(self, ids: List[str]) -> int:
+        """ Returns how many of the entries were still there. """
+        with RedisPool() as conn:
+            return conn.xdel(self.key, *ids)
+
+    def subscribe(self, subscriber: str) -> None:
+        """ New subscribers start reading from the entries appended after their subscription. """
+        if not subscriber in self.cursors:
+            self.cursors[subscriber] = self.last_id()
+
+    def unsubscribe(self, subscriber: str) -> None:
+        if subscriber in self.cursors:
+            del self.cursors[subscriber]
+            self.trim()
+
+    def read_for(self, subscriber: str, advance: bool, count: Optional[int] = None) -> List[Tuple[str, Dict[str, Any]]]:
+        """ Reads the entries after the subscriber's cursor, moving the cursor past them when 'advance' is set. """
+        entries = self.read(self.cursors[subscriber], count)
+        if advance and entries:
+            self.cursors[subscriber] = entries[-1][0]
+            self.trim()
+        return entries
+
+    def trim(self) -> None:
+        """ Drops the entries every subscriber has consumed already, keeping the oldest cursor's own entry. """
+        cursors = list(self.cursors.values())
+        if not cursors:
+            return
+        oldest = min(cursors, key=lambda c: tuple(int(part) for part in c.split("-")))
+        with RedisPool() as conn:
+            conn.execute_command("XTRIM", self.key, "MINID", oldest)
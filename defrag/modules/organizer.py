@@ -1,16 +1,23 @@
 import asyncio
-from defrag.modules.helpers.data_manipulation import partition_left_right
-from functools import reduce
-from defrag import app
+import json
+from collections import deque
+from defrag.modules.helpers.data_manipulation import partition_left_right, stable_digest
+from heapq import merge
+from itertools import islice, takewhile
+from defrag import LOGGER, app
+from fastapi import Header
+from fastapi.responses import Response, StreamingResponse
 from datetime import datetime, timedelta, timezone
+from defrag.modules.helpers.intervals import RedisIntervalIndex, WindowCache
 from defrag.modules.helpers.sync_utils import as_async
 from defrag.modules.db.redis import RedisPool
 from defrag.modules.helpers import EitherErrorOrOk, FailuresAndSuccesses, Query, QueryResponse
-from defrag.modules.dispatcher import Dispatcher, Dispatchable, Notification, TelegramNotification
+from defrag.modules.dispatcher import Destination, Dispatcher, Dispatchable, Notification, TelegramNotification
 from pottery import RedisDict
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple
 from dateutil import rrule
 from pydantic.main import BaseModel
+from redis.client import Pipeline
 from defrag.modules.helpers.requests import Req
 
 __MOD_NAME__ = "organizer"
@@ -18,6 +25,10 @@ __MOD_NAME__ = "organizer"
 CAL_NAME = "openSUSE Community Calendar"
 FEDOCAL_URL = ""
 POLL_INTERVAL = timedelta(days=15)
+SYNC_INTERVAL = timedelta(hours=1)
+# recurring events have their occurrences scheduled up to this many, and up to this many days ahead
+HORIZON_COUNT = 10
+HORIZON_DAYS = 30
 DATE_FORMAT = "%Y-%m-%d"
 TIME_FORMAT = "%H:%M:%S"
 FORMAT = f"{DATE_FORMAT} {TIME_FORMAT}"
@@ -50,29 +61,66 @@ class Rrule(BaseModel):
     In particular, if 'dtstart' is not set at initialization,
     the program's business logic will fallback on to the 'start' field
     declared on the CustomEvent instance the Rrule instance defined in the CustomEvent instance.
+    The fields are the RFC 5545 rule parts (plus dateutil's 'byeaster'), weekdays being written as in RFC 5545, e.g. 'MO', '+1FR' or '-1SU'.
+    Rules with neither 'until' nor 'count' go on forever.
     Look at https://dateutil.readthedocs.io/en/stable/rrule.html for reference about the 'rrule' language.
     """
-    until: str  # date str as FORMAT-ed above
     freq: str
     dtstart: Optional[str] = None   # date str as FORMAT-ed above
+    until: Optional[str] = None  # date str as FORMAT-ed above
+    count: Optional[int] = None
     interval: Optional[int] = None
+    wkst: Optional[str] = None
+    bysetpos: Optional[List[int]] = None
+    bymonth: Optional[List[int]] = None
+    bymonthday: Optional[List[int]] = None
+    byyearday: Optional[List[int]] = None
+    byeaster: Optional[List[int]] = None
+    byweekno: Optional[List[int]] = None
+    byweekday: Optional[List[str]] = None
+    byhour: Optional[List[int]] = None
+    byminute: Optional[List[int]] = None
+    bysecond: Optional[List[int]] = None
 
-    # TODO implement this:
-    """
-    wkst = None
-    count = None
-    bysetpos = None
-    bymonth = None
-    bymonthday = None
-    byyearday = None
-    byeaster = None
-    byweekno = None
-    byweekday = None
-    byhour = None
-    byminute = None
-    bysecond = None
-    cache = False
+    def to_rfc(self, utc: bool = False) -> str:
+        """ The rule as an RFC 5545 RRULE value. 'utc' marks 'until' as UTC, which the rule's start must then be too. """
+        parts = [f"FREQ={self.freq.upper()}"]
+        if self.interval:
+            parts.append(f"INTERVAL={self.interval}")
+        if self.count:
+            parts.append(f"COUNT={self.count}")
+        if self.until:
+            until = datetime.strptime(self.until, FORMAT).strftime("%Y%m%dT%H%M%S")
+            parts.append(f"UNTIL={until}{'Z' if utc else ''}")
+        if self.wkst:
+            parts.append(f"WKST={self.wkst.upper()}")
+        for name, values in [("BYSETPOS", self.bysetpos), ("BYMONTH", self.bymonth), ("BYMONTHDAY", self.bymonthday),
+                             ("BYYEARDAY", self.byyearday), ("BYEASTER", self.byeaster), ("BYWEEKNO", self.byweekno),
+                             ("BYDAY", self.byweekday), ("BYHOUR", self.byhour), ("BYMINUTE", self.byminute), ("BYSECOND", self.bysecond)]:
+            if values:
+                parts.append(f"{name}={','.join(str(v).upper() for v in values)}")
+        return ";".join(parts)
+
+
+# compiled rules by RFC 5545 value and start epoch, see 'compile_rule'
+compiled_rules: Dict[Tuple[str, float], rrule.rrule] = {}
+MAX_COMPILED_RULES = 4096
+# rules with a larger 'count' are rejected, as their last occurrence is found by walking them
+MAX_RRULE_COUNT = 5000
+
+
+def compile_rule(rule: str, dtstart: float) -> rrule.rrule:
+    """ 
+    Parses the rule only once. The compiled rules do not cache the occurrences they generate, which would keep
+    every occurrence ever walked in memory for as long as the rule is. Raises ValueError on invalid rules.
     """
+    key = (rule, dtstart)
+    if not key in compiled_rules:
+        if len(compiled_rules) >= MAX_COMPILED_RULES:
+            del compiled_rules[next(iter(compiled_rules))]
+        compiled_rules[key] = rrule.rrulestr(
+            rule, dtstart=datetime.fromtimestamp(dtstart))
+    return compiled_rules[key]
 
 
 class CustomEvent(BaseModel):
@@ -89,31 +137,104 @@ class CustomEvent(BaseModel):
     tags: Optional[List[str]] = None
     restricted: Optional[List[str]] = None
     rrule: Optional[Rrule] = None
+    # occurrences materialised so far, up to the 'horizon' (FORMAT-ed), beyond which they are generated lazily from the rule
     rruled_occurrences: Optional[List[str]] = None
+    horizon: Optional[str] = None
+    # notification and deltas the event was added with, kept to schedule the occurrences beyond the horizon
+    reminders: Optional[Dict[str, Any]] = None
     changelog: Optional[List[Dict[str, Any]]] = None
+    # epochs of the start, end, and end of the last occurrence (infinite for endless rules), computed once when adding, see 'stamped'
+    start_ts: Optional[float] = None
+    end_ts: Optional[float] = None
+    span_end_ts: Optional[float] = None
+    # the rule as an RFC 5545 value and the epoch it starts from, which stored events are compiled from, see 'event_rule'
+    rrule_rfc: Optional[str] = None
+    dtstart_ts: Optional[float] = None
+
+    def stamp(self) -> None:
+        """ 
+        Parses the start and end strings, and writes the rule out, once for all. The span of UNTIL rules ends with an occurrence
+        starting at 'until' at the latest, which may overestimate it (see 'occurs_within'). Only COUNT rules are walked to their
+        last occurrence, and these are bounded.
+        """
+        start, end = datetime.strptime(self.start, FORMAT), datetime.strptime(self.end, FORMAT)
+        self.start_ts, self.end_ts = start.timestamp(), end.timestamp()
+        if not self.rrule:
+            self.rrule_rfc = self.dtstart_ts = None
+            self.span_end_ts = self.end_ts
+            return
+        self.rrule_rfc = self.rrule.to_rfc()
+        self.dtstart_ts = datetime.strptime(self.rrule.dtstart, FORMAT).timestamp() if self.rrule.dtstart else self.start_ts
+        if self.rrule.count:
+            self.span_end_ts = ((self.last_occurrence() or start) + (end - start)).timestamp()
+        elif self.rrule.until:
+            self.span_end_ts = (datetime.strptime(self.rrule.until, FORMAT) + (end - start)).timestamp()
+        else:
+            self.span_end_ts = float("inf")
 
-    def apply_rrule(self) -> List[str]:
+    def rule(self) -> rrule.rrule:
         if not self.rrule:
             raise Exception(
                 f"Tried applied the instance's rrule, which is not defined yet.")
-        rule = None
-        freq = None
-        until = datetime.strptime(self.rrule.until, FORMAT)
-        dtstart = datetime.strptime(
-            self.rrule.dtstart, FORMAT) if self.rrule.dtstart else datetime.strptime(self.start, FORMAT)
-        if self.rrule.freq.upper() == "DAILY":
-            freq = rrule.DAILY
-        if self.rrule.freq.upper() == "WEEKLY":
-            freq = rrule.WEEKLY
-        if self.rrule.freq.upper() == "MONTHLY":
-            freq = rrule.MONTHLY
-        if self.rrule.interval:
-            rule = {"until": until, "freq": freq, "dtstart": dtstart,
-                    "interval": self.rrule.interval}
+        if self.rrule.count and self.rrule.count > MAX_RRULE_COUNT:
+            raise ValueError(f"count must not exceed {MAX_RRULE_COUNT}")
+        if self.rrule_rfc is not None and self.dtstart_ts is not None:
+            return compile_rule(self.rrule_rfc, self.dtstart_ts)
+        dtstart = datetime.strptime(self.rrule.dtstart or self.start, FORMAT)
+        return compile_rule(self.rrule.to_rfc(), dtstart.timestamp())
+
+    def apply_rrule(self, after: datetime, inc: bool = False, count: int = HORIZON_COUNT, days: int = HORIZON_DAYS) -> Tuple[List[datetime], Optional[datetime]]:
+        """
+        Generates the occurrences after 'after', at most 'count' of them and none later than 'days' from now.
+        Returns them along with the new horizon, or None as the horizon if the rule has no occurrences left beyond them.
+        Every occurrence up to the horizon is generated, those after it being left to the next window ('after' being exclusive then).
+        """
+        rule = self.rule()
+        bound = datetime.now() + timedelta(days=days)
+        occurrences = list(islice(takewhile(lambda d: d <= bound, rule.xafter(after, inc=inc)), count))
+        if len(occurrences) == count:
+            horizon = occurrences[-1]
+        elif after <= bound:
+            horizon = bound
         else:
-            rule = {"until": until, "freq": freq, "dtstart": dtstart}
-        occurrences = rrule.rrule(**rule)
-        return list(map(lambda d: datetime.strftime(d, FORMAT), occurrences))
+            # nothing generated yet: an occurrence at 'after' itself still belongs to the next window
+            horizon = after - timedelta(seconds=1) if inc else after
+        return occurrences, horizon if rule.after(horizon) else None
+
+    def set_window(self, occurrences: List[datetime], horizon: Optional[datetime]) -> None:
+        """ Records the materialised occurrences and the horizon, formatted for the API. """
+        self.rruled_occurrences = [d.strftime(FORMAT) for d in occurrences]
+        self.horizon = horizon.strftime(FORMAT) if horizon else None
+
+    def last_occurrence(self) -> Optional[datetime]:
+        """ Walks the rule without materialising it. None if the rule goes on forever or has no occurrence at all. """
+        if self.rrule.until:
+            return self.rule().before(datetime.strptime(self.rrule.until, FORMAT), inc=True)
+        if self.rrule.count:
+            return next(iter(deque(self.rule(), maxlen=1)), None)
+        return None
+
+
+def stamped(event: Dict[str, Any]) -> Dict[str, Any]:
+    """ The stored event, stamped (see 'CustomEvent.stamp') if it was stored before its epochs and rule string were. """
+    if event.get("start_ts") is None or (event.get("rrule") and event.get("rrule_rfc") is None):
+        event = CustomEvent(**event)
+        event.stamp()
+        return event.dict()
+    return event
+
+
+def event_rule(event: Dict[str, Any]) -> rrule.rrule:
+    """ The rule of a stamped recurring event, compiled straight from the stored values. """
+    return compile_rule(event["rrule_rfc"], event["dtstart_ts"])
+
+
+def occurs_within(event: Dict[str, Any], start: datetime, end: datetime) -> bool:
+    """ Whether any occurrence of the stamped event overlaps [start, end]. """
+    if not event.get("rrule"):
+        return True
+    first = event_rule(event).after(start - timedelta(seconds=event["end_ts"] - event["start_ts"]), inc=True)
+    return first is not None and first <= end
 
 
 # ---------
@@ -131,13 +252,67 @@ def assemble_to_datetime(d: str, t: str) -> datetime:
     return datetime.strptime(f"{d} {t}", FORMAT)
 
 
+def ics_text(value: str) -> str:
+    return value.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+
+def ics_line(line: str) -> str:
+    """ Folds the content line at 75 octets, as per RFC 5545. """
+    folded, chunk = [], b""
+    for char in line:
+        encoded = char.encode("utf-8")
+        if len(chunk) + len(encoded) > (75 if not folded else 74):
+            folded.append(chunk.decode("utf-8"))
+            chunk = b""
+        chunk += encoded
+    folded.append(chunk.decode("utf-8"))
+    return "\r\n ".join(folded) + "\r\n"
+
+
+def event_to_ics(event: Dict[str, Any]) -> str:
+    """ A VEVENT with times in UTC, recurring events carrying their RRULE rather than their occurrences. """
+    def utc(d: datetime) -> str:
+        return d.strftime("%Y%m%dT%H%M%SZ")
+    if event.get("start_ts") is not None:
+        start, end = datetime.fromtimestamp(event["start_ts"]), datetime.fromtimestamp(event["end_ts"])
+    else:
+        start, end = datetime.strptime(event["start"], FORMAT), datetime.strptime(event["end"], FORMAT)
+    rule = Rrule(**event["rrule"]) if event.get("rrule") else None
+    if event.get("dtstart_ts") is not None:
+        dtstart = datetime.fromtimestamp(event["dtstart_ts"])
+    else:
+        dtstart = datetime.strptime(rule.dtstart, FORMAT) if rule and rule.dtstart else start
+    lines = [
+        "BEGIN:VEVENT",
+        f"UID:{event['id']}@defrag",
+        f"DTSTAMP:{utc(datetime.utcnow())}",
+        f"DTSTART:{utc(dtstart)}",
+        f"DTEND:{utc(dtstart + (end - start))}",
+        f"SUMMARY:{ics_text(event['title'])}",
+        f"DESCRIPTION:{ics_text(event['description'])}",
+        f"LOCATION:{ics_text(event['location'])}",
+        f"STATUS:{'CANCELLED' if event.get('status') == 'cancelled' else 'CONFIRMED'}",
+        *([f"RRULE:{rule.to_rfc(utc=True)}"] if rule else []),
+        "END:VEVENT"
+    ]
+    return "".join(ics_line(line) for line in lines)
+
+
+def build_schedules(targets: List[float], offsets: List[float]) -> List[float]:
+    """
+    Shifts the sorted 'targets' epochs by each offset, and merges the shifted runs, each of them sorted already,
+    into the sorted schedules in a single pass: O(n * k * log(k)) for n targets and k (at most 4) offsets.
+    """
+    return list(merge(*[[t - offset for t in targets] for offset in offsets]))
+
+
 def event_from_fedocal(m: FedocalEvent) -> CustomEvent:
     start = assemble_to_datetime(
         m.event_date, m.event_time_start).strftime(FORMAT)
     end = assemble_to_datetime(
         m.event_date_end, m.event_time_stop).strftime(FORMAT)
     return CustomEvent(
-        id=m.event_id,
+        id=str(m.event_id),
         title=m.event_name,
         manager=m.event_manager,
         creator=CAL_NAME,
@@ -182,7 +357,8 @@ class Reminders(BaseModel):
     Instances of this class are supposed to be passed along with instances of CustomEvent
     to specificy the notification behaviour expected by the user registering the event.
     This makes sense for community events with a dedicated news channel, but it does not make sense
-        - (TODO) for users interested to have their own notifications about an event that already exits (as well as its (re)occurrences)
+        - for users interested to have their own notifications about an event that already exits (as well as its (re)occurrences).
+            These subscribe to the event instead, see 'EventSubscription'.
         - for users users interested to have their own notifications independently of any calendar items (these are expected 
             to set their own reminders using the 'set_reminders' endpoint. The function creates reminders independently of any event.
     """
@@ -194,18 +370,19 @@ class Reminders(BaseModel):
         minutes: Optional[int]
 
         def apply(self, tgt: str) -> List[float]:
-            deltas = []
-            dtgt = datetime.strptime(tgt, FORMAT)
-            if self.weeks:
-                deltas.append((dtgt - timedelta(weeks=self.weeks)).timestamp())
-            if self.days:
-                deltas.append((dtgt - timedelta(days=self.days)).timestamp())
-            if self.hours:
-                deltas.append((dtgt - timedelta(hours=self.hours)).timestamp())
-            if self.minutes:
-                deltas.append(
-                    (dtgt - timedelta(hours=self.minutes)).timestamp())
-            return deltas
+            return self.apply_ts(datetime.strptime(tgt, FORMAT).timestamp())
+
+        def apply_ts(self, tgt: float) -> List[float]:
+            return [tgt - offset for offset in self.offsets()]
+
+        def offsets(self) -> List[float]:
+            """ How many seconds before their target the reminders are due. """
+            return [timedelta(**{unit: n}).total_seconds() for unit, n in [
+                ("weeks", self.weeks), ("days", self.days), ("hours", self.hours), ("minutes", self.minutes)] if n]
+
+        def schedules(self, targets: List[float]) -> List[float]:
+            """ The reminders of all the (sorted) targets, sorted. See 'build_schedules'. """
+            return build_schedules(targets, self.offsets())
 
     notification: Notification
     deltas: UserDeltas
@@ -216,6 +393,13 @@ class Reminders(BaseModel):
         await Dispatcher.put(Dispatchable(origin="reminders", schedules=deltas.apply(tgt), notification=notification))
 
 
+class EventSubscription(BaseModel):
+    """ A user's own reminders about a calendar event, see 'Calendar.subscribe'. """
+    subscriber_id: str
+    destination: Destination
+    deltas: Reminders.UserDeltas
+
+
 # --------
 # CALENDAR
 # --------
@@ -226,41 +410,273 @@ class Calendar:
     # holds the actual calendar items
     container = RedisDict({}, redis=RedisPool().connection,
                           key=CAL_NAME)
-    # maps str hashes into datetimes for quicker access
-    viewer: Dict[str, datetime] = {}
+    # the items' time spans by id, shared by all workers, for range queries without scanning the container.
+    # Workers answering many range queries may keep a local mirror of it by running 'index.mirror()'.
+    index = RedisIntervalIndex(CAL_NAME)
+    index_checked = False
+
+    # rendered views of the calendar, evicted by the spans of the events written since they were rendered
+    renders = WindowCache(f"{CAL_NAME}_renders")
+
+    # sorted set of the recurring events' ids, scored by their horizon
+    horizons_key = f"{CAL_NAME}_horizons"
+
+    # bumped on every add or cancellation, tags the cached .ics feed
+    version_key = f"{CAL_NAME}_version"
+    # hash holding the last rendered .ics 'feed' and the 'version' it was rendered at
+    ics_cache_key = f"{CAL_NAME}_ics"
+
+    # Fedocal sync state: the date from which Fedocal is fetched, the synced Fedocal ids mapped to
+    # their calendar id and digest, and the same ids scored by start (to tell which ones should have been fetched).
+    fedocal_watermark_key = "fedocal_watermark"
+    fedocal_synced_key = "fedocal_synced"
+    fedocal_starts_key = "fedocal_starts"
+    fedocal_deltas = Reminders.UserDeltas(days=1, hours=1)
+
+    # Users' own reminders about an event are kept per event: its subscribers along with their destination and offsets, 
+    # and the number of subscribers of each offset. Each distinct offset is a single scheduled item, fanned out to the
+    # subscribers of its topic (see 'reminder_topic'), whatever the number of subscribers.
+
+    @staticmethod
+    def subscriptions_key(event_id: str) -> str:
+        return f"{CAL_NAME}_subscriptions_{event_id}"
+
+    @staticmethod
+    def offsets_key(event_id: str) -> str:
+        return f"{CAL_NAME}_reminder_offsets_{event_id}"
+
+    @staticmethod
+    def cancelled_key(event_id: str) -> str:
+        """ Set while the event is cancelled, for (un)subscriptions to watch it rather than the whole container. """
+        return f"{CAL_NAME}_cancelled_{event_id}"
+
+    @staticmethod
+    def reminder_topic(event_id: str, offset: int) -> str:
+        """ Topic, and id of the scheduled item, of the reminders due 'offset' seconds before the event's occurrences. """
+        return f"event:{event_id}:{offset}"
 
     @classmethod
-    async def add(cls, _event: CustomEvent, notification: Notification, deltas: Reminders.UserDeltas) -> EitherErrorOrOk:
-        """ Adds an item to the calendar, computes it's occurrences, schedules the notification messages as reminders. """
-        
-        # setup
-        event, at = cls.prime_event(_event), datetime.strptime(_event.start, FORMAT)
+    def load_index(cls) -> None:
+        """ Once per process, indexes the events stored before the index was, if any. """
+        if cls.index_checked:
+            return
+        if not len(cls.index) and len(cls.container):
+            with RedisPool(pipeline=True) as pipe:
+                for m in map(stamped, cls.container.values()):
+                    cls.index.add(pipe, m["id"], m["start_ts"], m["span_end_ts"])
+                    cls.renders.changing(pipe, m["start_ts"], m["span_end_ts"])
+                pipe.execute()
+        cls.index_checked = True
 
-        # errors handling
-        if not cls.viewer:
-            # need to populate the viewer
-            cls.viewer = {m['id']: datetime.strptime(m['start'], FORMAT) for m in cls.container}
-        if event.id in cls.viewer:
-            return EitherErrorOrOk(error=f"Unable to add this event as it was added already: {str(event)}")        
-        
-        # occurrences and dispatchable
-        future_occurrences = event.apply_rrule() if event.rrule else [event.start]
-        schedules: List[float] = reduce(lambda acc, o: acc + deltas.apply(o), future_occurrences, [])
-        disp = Dispatchable(
+    @staticmethod
+    def prepare(event: CustomEvent, notification: Notification, deltas: Reminders.UserDeltas) -> Optional[Dispatchable]:
+        """ 
+        Computes the occurrences of a primed event (up to the horizon for recurring events), marks it active, 
+        and returns the dispatchable of its reminders, if any.
+        """
+        event.stamp()
+        if event.rrule:
+            start = datetime.strptime(event.rrule.dtstart, FORMAT) if event.rrule.dtstart else datetime.fromtimestamp(event.start_ts)
+            future_occurrences, horizon = event.apply_rrule(after=max(start, datetime.now()), inc=True)
+            event.set_window(future_occurrences, horizon)
+            schedules: List[float] = deltas.schedules([o.timestamp() for o in future_occurrences])
+        else:
+            event.rruled_occurrences = [event.start]
+            schedules = deltas.apply_ts(event.start_ts)
+        event.status = "active"
+        event.reminders = {"notification": notification.dict(), "deltas": deltas.dict()}
+        if not schedules:
+            return None
+        return Dispatchable(
             origin=CAL_NAME,
             notification=notification,
             id=event.id,
             schedules=schedules
         )
+
+    @classmethod
+    def writing(cls, pipe: Pipeline, event: CustomEvent) -> None:
+        """ Queues the writes storing and indexing the event into the pipeline. """
+        item = stamped(event.dict())
+        pipe.hset(cls.container.key, cls.container._encode(event.id), cls.container._encode(item))
+        pipe.delete(cls.cancelled_key(event.id))
+        cls.index.add(pipe, event.id, item["start_ts"], item["span_end_ts"])
+        cls.renders.changing(pipe, item["start_ts"], item["span_end_ts"])
+        pipe.incr(cls.version_key)
+        if event.horizon:
+            pipe.zadd(cls.horizons_key, {event.id: datetime.strptime(event.horizon, FORMAT).timestamp()})
+        else:
+            pipe.zrem(cls.horizons_key, event.id)
+
+    @staticmethod
+    def targets(event: CustomEvent) -> List[float]:
+        """ 
+        Epochs of the upcoming occurrences, up to the horizon for recurring events (beyond which 'extend_horizon' takes over).
+        Generated from the rule, as 'rruled_occurrences' only holds the latest window.
+        """
+        if not event.rrule:
+            return [event.start_ts if event.start_ts is not None else datetime.strptime(event.start, FORMAT).timestamp()]
+        now = datetime.now()
+        if event.horizon:
+            upcoming = event.rule().between(now, datetime.strptime(event.horizon, FORMAT), inc=True)
+        else:
+            # the rule ends within the latest window
+            upcoming = list(islice(event.rule().xafter(now, inc=True), HORIZON_COUNT))
+        return [o.timestamp() for o in upcoming]
+
+    @classmethod
+    def reminder_item(cls, event: CustomEvent, offset: int, targets: List[float]) -> Dict[str, Any]:
+        """ The scheduled item of the reminders due 'offset' seconds before the 'targets', leaving out those due already. """
+        now = datetime.now().timestamp()
+        topic = cls.reminder_topic(event.id, offset)
+        notification = {"body": f"Reminder: '{event.title}' is coming up in {timedelta(seconds=offset)}",
+                        "email_object": f"Reminder: {event.title}", "poll_do_not_push": False}
+        return Dispatchable.construct(origin=CAL_NAME, notification=notification, id=topic, topic=topic,
+                                      schedules=[t - offset for t in targets if t - offset > now]).dict()
+
+    @classmethod
+    def reminder_offsets(cls, event_ids: List[str], watched: Optional[Pipeline] = None) -> Dict[str, List[int]]:
+        """ The distinct offsets subscribed to, by event, read through the 'watched' pipeline if within a transaction. """
+        if watched is not None:
+            return {event_id: [int(o) for o in watched.hkeys(cls.offsets_key(event_id))] for event_id in event_ids}
+        with RedisPool(pipeline=True) as pipe:
+            for event_id in event_ids:
+                pipe.hkeys(cls.offsets_key(event_id))
+            return {event_id: [int(o) for o in offsets] for event_id, offsets in zip(event_ids, pipe.execute())}
+
+    @classmethod
+    def dropping_reminders(cls, pipe: Pipeline, event_id: str, offsets: List[int]) -> None:
+        """ Queues the removal of the event's subscriptions, and of the reminders scheduled for them, into the pipeline. """
+        for offset in offsets:
+            topic = cls.reminder_topic(event_id, offset)
+            Dispatcher.unscheduling(keys=Dispatcher.schedule_keys(topic), args=[Dispatcher.scheduled._encode(topic)], client=pipe)
+            pipe.delete(Dispatcher.topic_key(topic))
+        pipe.delete(cls.subscriptions_key(event_id), cls.offsets_key(event_id))
+
+    @classmethod
+    def rescheduling_reminders(cls, pipe: Pipeline, event: CustomEvent, offsets: List[int]) -> None:
+        """ Queues the replacement of the reminders scheduled for the event's subscriptions with those of its current occurrences. """
+        for offset in offsets:
+            topic = cls.reminder_topic(event.id, offset)
+            Dispatcher.unscheduling(keys=Dispatcher.schedule_keys(topic), args=[Dispatcher.scheduled._encode(topic)], client=pipe)
+            item = cls.reminder_item(event, offset, cls.targets(event))
+            if item["schedules"]:
+                Dispatcher.schedule(item, client=pipe)
+
+    @classmethod
+    def subscribing(cls, event_id: str, subscriber_id: str, destination: Optional[Destination], offsets: List[float]) -> Optional[bool]:
+        """
+        Sets the subscriber's offsets, none meaning unsubscribing, and moves the subscriber across the offsets' topics.
+        Offsets subscribed to for the first time get their reminders scheduled, those left without subscribers unscheduled.
+        Runs as a single WATCH/MULTI transaction over the event's subscriptions, counts and cancellation, retried whenever 
+        a concurrent (un)subscription or cancellation lands in between. Returns whether the subscriber was subscribed already,
+        or None without subscribing if the event is missing or cancelled.
+        """
+        new = {int(o) for o in offsets}
+
+        def updating(pipe: Pipeline) -> Optional[bool]:
+            event, targets = None, []
+            if new:
+                item = pipe.hget(cls.container.key, cls.container._encode(event_id))
+                if pipe.exists(cls.cancelled_key(event_id)) or not item:
+                    return None
+                event = CustomEvent(**cls.container._decode(item))
+                if event.status == "cancelled":
+                    return None
+                targets = cls.targets(event)
+            previous = pipe.hget(cls.subscriptions_key(event_id), subscriber_id)
+            old = set(json.loads(previous)["offsets"]) if previous else set()
+            added, removed = sorted(new - old), sorted(old - new)
+            counts = pipe.hmget(cls.offsets_key(event_id), removed) if removed else []
+            pipe.multi()
+            for offset, count in zip(removed, counts):
+                topic = cls.reminder_topic(event_id, offset)
+                pipe.hdel(Dispatcher.topic_key(topic), subscriber_id)
+                if int(count or 0) > 1:
+                    pipe.hincrby(cls.offsets_key(event_id), offset, -1)
+                else:
+                    pipe.hdel(cls.offsets_key(event_id), offset)
+                    Dispatcher.unscheduling(keys=Dispatcher.schedule_keys(topic), args=[Dispatcher.scheduled._encode(topic)], client=pipe)
+            for offset in added:
+                pipe.hincrby(cls.offsets_key(event_id), offset, 1)
+                # a no-op for the offsets scheduled already
+                item = cls.reminder_item(event, offset, targets)
+                if item["schedules"]:
+                    Dispatcher.schedule(item, client=pipe)
+            if new:
+                target = json.dumps(destination.dict(exclude_none=True))
+                for offset in new:
+                    pipe.hset(Dispatcher.topic_key(cls.reminder_topic(event_id, offset)), subscriber_id, target)
+                pipe.hset(cls.subscriptions_key(event_id), subscriber_id, json.dumps(
+                    {"destination": destination.dict(exclude_none=True), "offsets": sorted(new)}))
+                pipe.sadd(Dispatcher.subscribed_pushees.key, Dispatcher.subscribed_pushees._encode(subscriber_id))
+            else:
+                pipe.hdel(cls.subscriptions_key(event_id), subscriber_id)
+            return bool(previous)
+
+        with RedisPool() as conn:
+            return conn.transaction(updating, cls.subscriptions_key(event_id), cls.offsets_key(event_id), cls.cancelled_key(event_id),
+                                    value_from_callable=True)
+
+    @classmethod
+    async def subscribe(cls, event_id: str, subscription: EventSubscription) -> EitherErrorOrOk:
+        """ 
+        Subscribes a user to reminders about the event and its occurrences, replacing the user's previous subscription if any.
+        Subscriptions follow the event: they are rescheduled along with its occurrences, and dropped when it is cancelled.
+        """
+        offsets = subscription.deltas.offsets()
+        if not offsets:
+            return EitherErrorOrOk(error=f"Unable to subscribe to {event_id} without any delta: {subscription}")
+
+        if await as_async(cls.subscribing)(event_id, subscription.subscriber_id, subscription.destination, offsets) is None:
+            return EitherErrorOrOk(error=f"Unable to find this calendar item: {event_id}")
+        return EitherErrorOrOk(ok=event_id)
+
+    @classmethod
+    async def unsubscribe(cls, event_id: str, subscriber_id: str) -> bool:
+        """ Returns whether the subscriber was subscribed to the event. """
+        if not await as_async(cls.container.__contains__)(event_id):
+            return False
+        return await as_async(cls.subscribing)(event_id, subscriber_id, None, [])
+
+    @staticmethod
+    def cancelled(item: Dict[str, Any]) -> Dict[str, Any]:
+        status = "cancelled"
+        return {**item, "status": status, "changelog": [*(item.get("changelog") or []), {"action": status, "at": datetime.now().strftime(FORMAT)}]}
+
+    @classmethod
+    async def add(cls, _event: CustomEvent, notification: Notification, deltas: Reminders.UserDeltas, lane: Optional[str] = None) -> EitherErrorOrOk:
+        """ 
+        Adds an item to the calendar, computes its occurrences, schedules the notification messages as reminders.
+        Recurring events only have their occurrences up to the horizon computed, see 'extend_horizons'.
+        """
         
-        def inserting(event_id: str) -> None:
-            event.status = "active"
-            event.rruled_occurrences = future_occurrences
-            cls.container[event_id] = event.dict()
+        # setup
+        event = cls.prime_event(_event)
+
+        # errors handling
+        await as_async(cls.load_index)()
+        if (await as_async(cls.index.contains)([event.id]))[0]:
+            return EitherErrorOrOk(error=f"Unable to add this event as it was added already: {str(event)}")        
+        if event.rrule:
+            try:
+                event.rule()
+            except ValueError as error:
+                return EitherErrorOrOk(error=f"Unable to add this event as its rrule is invalid ({error}): {str(event)}")
         
-        # scheduling notifications and running redis job, then updating the viewer
-        await asyncio.gather(Dispatcher.put(disp), as_async(inserting)(event.id))
-        cls.viewer[event.id] = at
+        # occurrences and dispatchable, off the loop as walking rules may take a while
+        disp = await as_async(cls.prepare)(event, notification, deltas)
+
+        def inserting() -> None:
+            with RedisPool(pipeline=True) as pipe:
+                cls.writing(pipe, event)
+                pipe.execute()
+
+        # scheduling notifications and running redis job
+        jobs = [as_async(inserting)()]
+        if disp:
+            jobs.append(Dispatcher.put(disp, lane))
+        await asyncio.gather(*jobs)
 
         # we're returning this so that the caller / user knows which ids have been used.
         # required for cancellation.
@@ -270,21 +686,185 @@ class Calendar:
     async def cancel(cls, event_id: str) -> EitherErrorOrOk:
         """ Removes an item from the calendar, to implement the 'cancellation' behaviour expected by the user. """
         
-        if not event_id in cls.viewer:
+        await as_async(cls.load_index)()
+        if not (await as_async(cls.index.contains)([event_id]))[0]:
             return EitherErrorOrOk(error=f"Unable to cancel any event with id {event_id} as it matches not event in cache")
 
-        # work for redis
-        def cancelling(key: str) -> None:
-            item = cls.container[key]
-            status = "cancelled"
-            item["status"] = status
-            item["changelog"].append({"action": status, "at": datetime.now().strftime(FORMAT)})
-            cls.container[key] = item
+        # work for redis: the event, its reminders and its subscribers' are all cancelled in one transaction, 
+        # retried whenever a (un)subscription lands between reading the offsets subscribed to and cancelling them
+        def cancelling(pipe: Pipeline) -> None:
+            offsets = cls.reminder_offsets([event_id], watched=pipe)[event_id]
+            item = stamped(cls.cancelled(cls.container._decode(pipe.hget(cls.container.key, cls.container._encode(event_id)))))
+            pipe.multi()
+            pipe.hset(cls.container.key, cls.container._encode(event_id), cls.container._encode(item))
+            pipe.set(cls.cancelled_key(event_id), 1)
+            cls.renders.changing(pipe, item["start_ts"], item["span_end_ts"])
+            pipe.zrem(cls.horizons_key, event_id)
+            pipe.incr(cls.version_key)
+            Dispatcher.unscheduling(keys=Dispatcher.schedule_keys(event_id), args=[Dispatcher.scheduled._encode(event_id)], client=pipe)
+            cls.dropping_reminders(pipe, event_id, offsets)
+
+        def transacting() -> None:
+            with RedisPool() as conn:
+                conn.transaction(cancelling, cls.subscriptions_key(event_id), cls.offsets_key(event_id))
 
-        # running jobs, cancelling notifications
-        await asyncio.gather(Dispatcher.unschedule(event_id), as_async(cancelling)(event_id))
+        await as_async(transacting)()
         return EitherErrorOrOk(ok=event_id)
 
+    @classmethod
+    async def extend_horizons(cls, interval: int = 3600) -> None:
+        """ 
+        Leader job (see Dispatcher.leader_jobs): every 'interval', schedules the next occurrences of the recurring events
+        whose horizon is less than HORIZON_DAYS away, so that each event only ever has a bounded number of occurrences scheduled.
+        """
+        await as_async(LOGGER.info)("Started to extend the recurring events' horizons")
+        while True:
+            try:
+                extended = await as_async(cls.extend_due_horizons)()
+                if extended:
+                    await as_async(LOGGER.info)(f"Extended the horizon of {extended} recurring events")
+            except Exception as error:
+                await as_async(LOGGER.error)(f"Unable to extend the recurring events' horizons: {error}")
+            await asyncio.sleep(interval)
+
+    @classmethod
+    def extend_due_horizons(cls) -> int:
+        bound = (datetime.now() + timedelta(days=HORIZON_DAYS)).timestamp()
+        with RedisPool() as conn:
+            event_ids = [i.decode("utf-8") for i in conn.zrangebyscore(cls.horizons_key, "-inf", bound)]
+        extended = 0
+        for event_id in event_ids:
+            try:
+                cls.extend_horizon(event_id)
+                extended += 1
+            except Exception as error:
+                # left in the horizons, to be retried on the next run
+                LOGGER.error(f"Unable to extend the horizon of {event_id}: {error}")
+        return extended
+
+    @classmethod
+    def extend_horizon(cls, event_id: str) -> None:
+        """ Schedules the event's occurrences following its horizon, and moves the horizon past them. """
+        event = CustomEvent(**cls.container[event_id]) if event_id in cls.container else None
+        if not event or event.status == "cancelled" or not event.horizon or not event.reminders:
+            with RedisPool() as conn:
+                conn.zrem(cls.horizons_key, event_id)
+            return
+        occurrences, horizon = event.apply_rrule(after=datetime.strptime(event.horizon, FORMAT))
+        event.set_window(occurrences, horizon)
+        deltas = Reminders.UserDeltas(**event.reminders["deltas"])
+        targets = [o.timestamp() for o in occurrences]
+        schedules = deltas.schedules(targets)
+        if schedules:
+            # the notification is kept as a plain dict, so as not to lose the fields of its subclass
+            Dispatcher.extend(Dispatchable.construct(
+                origin=CAL_NAME, notification=event.reminders["notification"], id=event.id, schedules=schedules).dict())
+        for offset in cls.reminder_offsets([event_id])[event_id]:
+            item = cls.reminder_item(event, offset, targets)
+            if item["schedules"]:
+                Dispatcher.extend(item)
+        item = stamped(event.dict())
+        with RedisPool(pipeline=True) as pipe:
+            pipe.hset(cls.container.key, cls.container._encode(event_id), cls.container._encode(item))
+            # the rendered views hold the materialised occurrences
+            cls.renders.changing(pipe, item["start_ts"], item["span_end_ts"])
+            if horizon:
+                pipe.zadd(cls.horizons_key, {event_id: horizon.timestamp()})
+            else:
+                pipe.zrem(cls.horizons_key, event_id)
+            pipe.execute()
+
+    @classmethod
+    async def sync_fedocal_forever(cls, interval: timedelta = SYNC_INTERVAL) -> None:
+        """ Leader job (see Dispatcher.leader_jobs), registered if FEDOCAL_URL is set. """
+        await as_async(LOGGER.info)("Started to sync the calendar with Fedocal")
+        while True:
+            try:
+                changes = await cls.sync_fedocal()
+                if any(changes.values()):
+                    await as_async(LOGGER.info)(f"Synced the calendar with Fedocal: {changes}")
+            except Exception as error:
+                await as_async(LOGGER.error)(f"Unable to sync the calendar with Fedocal: {error}")
+            await asyncio.sleep(interval.total_seconds())
+
+    @classmethod
+    async def sync_fedocal(cls, deltas: Optional[Reminders.UserDeltas] = None) -> Dict[str, int]:
+        """
+        Fetches Fedocal from the watermark on and applies the difference with the previous sync in one pipeline:
+        new events are added, changed events replaced, and events missing from their window cancelled.
+        Fedocal cannot filter by modification time, so changes are told apart by digest. The watermark then moves to today,
+        dropping the sync state of the past events.
+        """
+        deltas = deltas or cls.fedocal_deltas
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+
+        def watermark() -> datetime:
+            with RedisPool() as conn:
+                value = conn.get(cls.fedocal_watermark_key)
+            return datetime.fromtimestamp(float(value)) if value else today
+
+        since = await as_async(watermark)()
+        fetched = {str(m.event_id): m for m in await cls.poll_fedocal(start=since)}
+        until = datetime.now() + POLL_INTERVAL
+        to_put: List[Dispatchable] = []
+
+        def syncing() -> Dict[str, int]:
+            with RedisPool() as conn:
+                expected = [i.decode("utf-8") for i in conn.zrangebyscore(cls.fedocal_starts_key, since.timestamp(), until.timestamp())]
+                past = [i.decode("utf-8") for i in conn.zrangebyscore(cls.fedocal_starts_key, "-inf", f"({today.timestamp()}")]
+                fedocal_ids = list({*fetched, *expected})
+                synced = {i: json.loads(v) for i, v in zip(fedocal_ids, conn.hmget(cls.fedocal_synced_key, fedocal_ids) if fedocal_ids else []) if v}
+            digests = {i: stable_digest(m.dict()) for i, m in fetched.items()}
+            changed = [i for i in fetched if not i in synced or synced[i]["digest"] != digests[i]]
+            gone = [i for i in expected if not i in fetched and i in synced]
+            stale_ids = [synced[i]["id"] for i in changed + gone if i in synced]
+
+            events = {}
+            for i in changed:
+                event = cls.prime_event(event_from_fedocal(fetched[i]))
+                notification = TelegramNotification(body=fetched[i].event_information, poll_do_not_push=True)
+                if disp := cls.prepare(event, notification, deltas):
+                    to_put.append(disp)
+                events[i] = event
+            # replaced events keep their id as long as their times are the same, and their subscriptions along with it
+            to_cancel = [e for e in stale_ids if not e in {event.id for event in events.values()}]
+            # retried whenever a (un)subscription to a stale event lands between reading its offsets and rescheduling them
+            def applying(pipe: Pipeline) -> None:
+                to_cancel_items = pipe.hmget(cls.container.key, [cls.container._encode(e) for e in to_cancel]) if to_cancel else []
+                offsets = cls.reminder_offsets(stale_ids, watched=pipe)
+                pipe.multi()
+                for event_id in stale_ids:
+                    Dispatcher.unscheduling(keys=Dispatcher.schedule_keys(event_id), args=[
+                        Dispatcher.scheduled._encode(event_id)], client=pipe)
+                for event_id, item in zip(to_cancel, to_cancel_items):
+                    if item:
+                        cancelled = stamped(cls.cancelled(cls.container._decode(item)))
+                        pipe.hset(cls.container.key, cls.container._encode(event_id), cls.container._encode(cancelled))
+                        pipe.set(cls.cancelled_key(event_id), 1)
+                        cls.renders.changing(pipe, cancelled["start_ts"], cancelled["span_end_ts"])
+                    pipe.zrem(cls.horizons_key, event_id)
+                    pipe.incr(cls.version_key)
+                    cls.dropping_reminders(pipe, event_id, offsets[event_id])
+                for i, event in events.items():
+                    cls.writing(pipe, event)
+                    if event.id in offsets:
+                        cls.rescheduling_reminders(pipe, event, offsets[event.id])
+                    pipe.hset(cls.fedocal_synced_key, i, json.dumps({"id": event.id, "digest": digests[i]}))
+                    pipe.zadd(cls.fedocal_starts_key, {i: event.start_ts})
+                for i in gone + past:
+                    pipe.hdel(cls.fedocal_synced_key, i)
+                    pipe.zrem(cls.fedocal_starts_key, i)
+                pipe.set(cls.fedocal_watermark_key, today.timestamp())
+
+            with RedisPool() as conn:
+                conn.transaction(applying, *[key for e in stale_ids for key in [cls.subscriptions_key(e), cls.offsets_key(e)]])
+
+            return {"added": len([i for i in changed if not i in synced]), "updated": len([i for i in changed if i in synced]), "cancelled": len(gone)}
+
+        changes = await as_async(syncing)()
+        await asyncio.gather(*[Dispatcher.put(d, "bulk") for d in to_put])
+        return changes
+
     @classmethod
     async def add_all_new_events(
         cls,
@@ -292,26 +872,64 @@ class Calendar:
         deltas: Reminders.UserDeltas,
         events: Optional[List[CustomEvent]]
     ) -> FailuresAndSuccesses:
-        """ Adds many events using a single notification behaviour. Expected for community affairs. """
+        """ Adds many events using a single notification behaviour. Expected for community affairs. See 'add_many'. """
         
         to_add = events or []
         
         if not to_add:
             # fetching from the fedocal endpoint
             fedocal_events = await cls.poll_fedocal()
-            to_add = [event_from_fedocal(m) for m in fedocal_events if m.event_id not in cls.container.keys()]
+
+            def synced(ids: List[str]) -> List[Optional[bytes]]:
+                with RedisPool() as conn:
+                    return conn.hmget(cls.fedocal_synced_key, ids) if ids else []
+            known = await as_async(synced)([str(m.event_id) for m in fedocal_events])
+            to_add = [event_from_fedocal(m) for m, k in zip(fedocal_events, known) if not k]
         
-        results = await asyncio.gather(*[cls.add(m, notification, deltas) for m in to_add])
+        return await cls.add_many(to_add, notification, deltas)
+
+    @classmethod
+    async def add_many(cls, events: List[CustomEvent], notification: Notification, deltas: Reminders.UserDeltas) -> FailuresAndSuccesses:
+        """ 
+        Bulk version of 'add': validates and deduplicates the events in memory, then writes them and schedules their
+        reminders in a single pipeline, along with the index.
+        """
+        def adding() -> List[EitherErrorOrOk]:
+            cls.load_index()
+            results, to_write, to_schedule = [], {}, []
+            primed = [cls.prime_event(e) for e in events]
+            known = {e.id for e, exists in zip(primed, cls.index.contains([e.id for e in primed])) if exists}
+            for event in primed:
+                if event.id in known or event.id in to_write:
+                    results.append(EitherErrorOrOk(error=f"Unable to add this event as it was added already: {str(event)}"))
+                    continue
+                try:
+                    disp = cls.prepare(event, notification, deltas)
+                except ValueError as error:
+                    results.append(EitherErrorOrOk(error=f"Unable to add this event as its rrule is invalid ({error}): {str(event)}"))
+                    continue
+                if disp:
+                    to_schedule.append(disp)
+                to_write[event.id] = event
+                results.append(EitherErrorOrOk(ok={"id": event.id, "title": event.title, "start": event.start, "end": event.end}))
+            with RedisPool(pipeline=True) as pipe:
+                for event in to_write.values():
+                    cls.writing(pipe, event)
+                Dispatcher.schedule_many(to_schedule, pipe)
+                pipe.execute()
+            return results
+
+        results = await as_async(adding)()
         return FailuresAndSuccesses(*partition_left_right(results, lambda item: hasattr(item, "ok")))
 
     @staticmethod
-    async def poll_fedocal(interval=None) -> List[FedocalEvent]:
+    async def poll_fedocal(interval=None, start: Optional[datetime] = None) -> List[FedocalEvent]:
         """
-        For a given fedocal API endpoints, returns all the items found there between now and 
-        the set interval.
+        For a given fedocal API endpoints, returns all the items found there between 'start' (defaulting to now) and 
+        now plus the set interval.
         """
         now = datetime.now()
-        start, _ = disassemble_to_date_time(datetime.now())
+        start, _ = disassemble_to_date_time(start or now)
         end, _ = disassemble_to_date_time(now + (interval or POLL_INTERVAL))
         async with Req(FEDOCAL_URL, params={"start": start, "end": end}) as response:
             res = await response.json()
@@ -324,37 +942,96 @@ class Calendar:
         """
         to_schedule = [Dispatchable(id=m.event_id, origin="openSUSE_fedocal", schedules=user_deltas.apply(
             f"{m.event_date} {m.event_time_start}"), notification=TelegramNotification(body=m.event_information)) for m in events]
-        await asyncio.gather(*[Dispatcher.put(m) for m in to_schedule])
+        await asyncio.gather(*[Dispatcher.put(m, "bulk") for m in to_schedule])
         return EitherErrorOrOk(ok="Reminders set!")
 
     @staticmethod
     def prime_event(event: CustomEvent) -> CustomEvent:
-        event.id = str(abs(hash(event.creator + event.start + event.end)))
+        """ 
+        Derives the id from the creator and times, and drops any stamp sent along, 'stamp' deriving it from the fields. Fedocal events all share the same creator, so the id they carry from
+        Fedocal (see 'event_from_fedocal') goes into the digest too, lest simultaneous meetings collide.
+        """
+        if event.creator == CAL_NAME:
+            event.id = stable_digest([event.creator, event.id, event.start, event.end])
+        else:
+            event.id = stable_digest([event.creator, event.start, event.end])
+        event.start_ts = event.end_ts = event.span_end_ts = event.rrule_rfc = event.dtstart_ts = None
         event.changelog = [{"created": datetime.now().strftime(FORMAT)}]
         return event
 
+    @classmethod
+    def version(cls) -> str:
+        with RedisPool() as conn:
+            return (conn.get(cls.version_key) or b"0").decode("utf-8")
+
+    @classmethod
+    async def export_ics(cls, version: str, batch_size: int = 500) -> AsyncGenerator[str, None]:
+        """
+        Streams the calendar as an iCalendar feed, from the cache if it was rendered at 'version' already.
+        Otherwise renders it 'batch_size' events at a time while streaming it, then caches it.
+        """
+        def cached() -> Optional[str]:
+            with RedisPool() as conn:
+                cached_version, feed = conn.hmget(cls.ics_cache_key, ["version", "feed"])
+            return feed.decode("utf-8") if cached_version and cached_version.decode("utf-8") == version else None
+
+        def page(cursor: int) -> Tuple[int, str]:
+            with RedisPool() as conn:
+                cursor, items = conn.hscan(cls.container.key, cursor, count=batch_size)
+            return cursor, "".join(event_to_ics(cls.container._decode(v)) for v in items.values())
+
+        def caching(feed: str) -> None:
+            with RedisPool() as conn:
+                conn.hset(cls.ics_cache_key, mapping={"version": version, "feed": feed})
+
+        if feed := await as_async(cached)():
+            yield feed
+            return
+        chunks = ["".join(ics_line(line) for line in [
+            "BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//openSUSE//defrag//EN", f"X-WR-CALNAME:{ics_text(CAL_NAME)}"])]
+        yield chunks[0]
+        cursor = None
+        while cursor != 0:
+            cursor, chunk = await as_async(page)(cursor or 0)
+            chunks.append(chunk)
+            yield chunk
+        chunks.append(ics_line("END:VCALENDAR"))
+        yield chunks[-1]
+        await as_async(caching)("".join(chunks))
+
     @staticmethod
     async def render(start_str: str, end_str: str, also_cancelled: bool = False) -> List[Dict[str, Any]]:
         """
-        Returns a view of the calendar in the specified range encoded in the date strings arguments.
+        Returns a view of the calendar in the specified range encoded in the date strings arguments,
+        i.e. the events overlapping the range, fetching only these from the container.
+        Views are cached by range and flag until an event overlapping the range is written, see 'renders'.
         """
-        if not Calendar.container:
-            return []
-        
         start, end = datetime.strptime(start_str, FORMAT), datetime.strptime(end_str, FORMAT)
-        
-        after = [
-            k for k, v in Calendar.viewer.items()
-            if start <= v and v <= end
-        ]
-
-        condition = (lambda item: item["id"] in after) if also_cancelled else (
-            lambda item: item["id"] in after and item["status"] != "cancelled")
+        lo, hi = start.timestamp(), end.timestamp()
+        key = f"{lo}:{hi}:{also_cancelled}"
 
         def rendering() -> List[Dict[str, Any]]:
-            return [e for e in Calendar.container.values() if condition(e)]
+            if (cached := Calendar.renders.get(key)) is not None:
+                return cached
+            Calendar.load_index()
+            ids = Calendar.index.overlapping(lo, hi)
+            events = []
+            if ids:
+                with RedisPool() as conn:
+                    values = conn.hmget(Calendar.container.key, [Calendar.container._encode(i) for i in ids])
+                events = [Calendar.container._decode(v) for v in values if v]
+            if not also_cancelled:
+                events = [e for e in events if e["status"] != "cancelled"]
+            # recurring events may well span the range with none of their occurrences in it
+            events = [e for e in events if not e.get("rrule") or occurs_within(stamped(e), start, end)]
+            Calendar.renders.put(key, lo, hi, events)
+            return events
         return await as_async(rendering)()
 
+Dispatcher.leader_jobs["calendar_horizons"] = Calendar.extend_horizons
+if FEDOCAL_URL:
+    Dispatcher.leader_jobs["fedocal_sync"] = Calendar.sync_fedocal_forever
+
 # --------
 # HANDLERS
 # --------
@@ -370,22 +1047,22 @@ async def post_reminders(reminder: Reminders) -> QueryResponse:
 
 
 @app.post(f"/{__MOD_NAME__}/add_reminder_for/")
-async def post_reminders_for(event_id: int, reminders: Reminders) -> QueryResponse:
+async def post_reminders_for(event_id: str, subscription: EventSubscription) -> QueryResponse:
     query = Query(service=__MOD_NAME__)
-    reply = "Calendar is empty!"
-    if not Calendar.container:
-        return QueryResponse(query=query, error=reply)
-
-    def look_up(event_id): 
-        return Calendar.container[event_id] if event_id in Calendar.container.keys() else None
-    found = await as_async(look_up)(event_id)
-    if not found:
-        reply = f"Unable to find this calendar item: {event_id}"
-        return QueryResponse(query=query, error=reply)
-    await Reminders.schedule(tgt=found["start"], notification=reminders.notification, deltas=reminders.deltas)
+    result = await Calendar.subscribe(event_id, subscription)
+    if hasattr(result, "error"):
+        return QueryResponse(query=query, error=result.error)
     return QueryResponse(query=query, message=f"Thanks, reminders set for {event_id}")
 
 
+@app.post(f"/{__MOD_NAME__}/remove_reminder_for/")
+async def post_remove_reminders_for(event_id: str, subscriber_id: str) -> QueryResponse:
+    query = Query(service=__MOD_NAME__)
+    if await Calendar.unsubscribe(event_id, subscriber_id):
+        return QueryResponse(query=query, message=f"Reminders removed for {event_id}")
+    return QueryResponse(query=query, error=f"{subscriber_id} has no reminders set for {event_id}")
+
+
 @app.post(f"/{__MOD_NAME__}/add_fedocal_events/")
 async def post_fedocal_events(events: List[FedocalEvent], reminders: Reminders) -> QueryResponse:
     query = Query(service=__MOD_NAME__)
@@ -413,6 +1090,14 @@ async def post_cancel_event(event_id: str) -> QueryResponse:
         return QueryResponse(query=query, message=f"Unable to cancel {event_id}")
 
 
+@app.get(f"/{__MOD_NAME__}/calendar.ics")
+async def get_calendar_ics(if_none_match: Optional[str] = Header(None)) -> Response:
+    etag = f'"{await as_async(Calendar.version)()}"'
+    if if_none_match == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return StreamingResponse(Calendar.export_ics(etag.strip('"')), media_type="text/calendar", headers={"ETag": etag})
+
+
 @app.get(f"/{__MOD_NAME__}/calendar/")
 async def get_calendar(start: str, end: str) -> QueryResponse:
     query = Query(service=__MOD_NAME__)
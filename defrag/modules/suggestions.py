@@ -1,5 +1,6 @@
 from datetime import datetime, timedelta
 from pydantic.main import BaseModel
+from defrag.modules.helpers.data_manipulation import stable_digest
 from defrag.modules.helpers.sync_utils import as_async
 from typing import Any, Dict, List, Optional
 from defrag.modules.db.redis import RedisPool
@@ -7,6 +8,7 @@ from defrag import app
 from defrag.modules.helpers import QueryResponse, EitherErrorOrOk, Query
 from math import sqrt
 from pottery import RedisDict
+from redis.client import Pipeline
 
 __MODULE_NAME__ = "suggestions"
 
@@ -20,14 +22,135 @@ class Suggestions:
         start_datetime: Optional[str] = None
         end_datetime: Optional[str] = None
 
+    class Vote(BaseModel):
+        voter_id: str
+        sugg_id: str
+        vote: int
+
     container = RedisDict(
         {}, redis=RedisPool().connection, key="suggestions")
+    # the suggestions' keys scored by their 'score', for listing them without loading the container
+    scores_key = "suggestions_scores"
+    scores_checked = False
+    # the version of 'make_score' the stored scores were computed with, see 'load_scores'
+    scores_version_key = "suggestions_scores_version"
+    scores_migration_key = "suggestions_scores_migration"
+    SCORES_VERSION = 2
+    # shared by the scripts below: moving the voters of the suggestions stored before they had their own set into it,
+    # and the score as computed by 'make_score'
+    PRELUDE = """
+    local function migrate(item, voters_key)
+        if type(item['voters_ids']) ~= 'table' then
+            return false
+        end
+        for _, voter in ipairs(item['voters_ids']) do
+            redis.call('SADD', voters_key, voter)
+        end
+        item['voters_ids'] = nil
+        return true
+    end
+    local function score(item)
+        local n, z = item['votesFor'] + item['votesAgainst'], 1.96
+        if n == 0 then
+            return 0
+        end
+        local p = item['votesFor'] / n
+        local s = (p + z * z / (2 * n) - z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n))) / (1 + z * z / n)
+        return math.floor(s * 1000 + 0.5) / 1000
+    end
+    """
+    # applies a vote atomically: KEYS = [container, scores, voters], ARGV = [encoded key, key, voter_id, vote].
+    # Returns -1 for unknown suggestions, 0 if the voter voted already, 1 otherwise.
+    voting = RedisPool().connection.register_script(PRELUDE + """
+    local raw = redis.call('HGET', KEYS[1], ARGV[1])
+    if not raw then
+        return -1
+    end
+    local item = cjson.decode(raw)
+    local migrated = migrate(item, KEYS[3])
+    local voted = redis.call('SADD', KEYS[3], ARGV[3])
+    if voted == 1 then
+        if tonumber(ARGV[4]) == 1 then
+            item['votesFor'] = item['votesFor'] + 1
+        else
+            item['votesAgainst'] = item['votesAgainst'] + 1
+        end
+        item['score'] = score(item)
+        redis.call('ZADD', KEYS[2], item['score'], ARGV[2])
+    end
+    if voted == 1 or migrated then
+        redis.call('HSET', KEYS[1], ARGV[1], cjson.encode(item))
+    end
+    return voted
+    """)
+    # scores a suggestion again from its current counts, atomically with respect to votes: same KEYS and ARGV[1:2] as 'voting'
+    rescoring = RedisPool().connection.register_script(PRELUDE + """
+    local raw = redis.call('HGET', KEYS[1], ARGV[1])
+    if not raw then
+        return 0
+    end
+    local item = cjson.decode(raw)
+    migrate(item, KEYS[3])
+    item['score'] = score(item)
+    redis.call('ZADD', KEYS[2], item['score'], ARGV[2])
+    redis.call('HSET', KEYS[1], ARGV[1], cjson.encode(item))
+    return 1
+    """)
+
+    @classmethod
+    def load_scores(cls) -> None:
+        """ 
+        Once per process, rescores the suggestions stored before the current version of 'make_score', if any,
+        so that the sorted set never mixes scores computed in different ways. Only the worker taking the migration lock
+        rescores, one suggestion per script so as not to lose the votes landing meanwhile, the others checking again later.
+        """
+        if cls.scores_checked:
+            return
+        with RedisPool() as conn:
+            if int(conn.get(cls.scores_version_key) or 0) >= cls.SCORES_VERSION:
+                cls.scores_checked = True
+                return
+            if not conn.set(cls.scores_migration_key, 1, nx=True, ex=600):
+                return
+            encoded_keys = conn.hkeys(cls.container.key)
+        try:
+            for n in range(0, len(encoded_keys), cls.vote_batch_size):
+                with RedisPool(pipeline=True) as pipe:
+                    for encoded in encoded_keys[n:n + cls.vote_batch_size]:
+                        key = cls.container._decode(encoded)
+                        cls.rescoring(keys=cls.vote_keys(key), args=[encoded, key], client=pipe)
+                    pipe.execute()
+            with RedisPool() as conn:
+                conn.set(cls.scores_version_key, cls.SCORES_VERSION)
+            cls.scores_checked = True
+        finally:
+            with RedisPool() as conn:
+                conn.delete(cls.scores_migration_key)
+
+    @classmethod
+    def writing(cls, pipe: Pipeline, item: Dict[str, Any]) -> None:
+        """ Queues the writes storing the suggestion and its score into the pipeline. """
+        pipe.hset(cls.container.key, cls.container._encode(item["key"]), cls.container._encode(item))
+        pipe.zadd(cls.scores_key, {item["key"]: item["score"]})
+
+    @staticmethod
+    def voters_key(key: str) -> str:
+        return f"suggestions_voters_{key}"
+
+    @classmethod
+    def vote_keys(cls, key: str) -> List[str]:
+        return [cls.container.key, cls.scores_key, cls.voters_key(key)]
 
     @classmethod
     async def add(cls, new_suggestion: New) -> EitherErrorOrOk:
         instance: Suggestions = cls(**new_suggestion.dict())
         if not instance.key in cls.container:
-            await as_async(lambda: cls.container.__setitem__(instance.key, instance.dict()))()
+            def adding() -> None:
+                with RedisPool(pipeline=True) as pipe:
+                    cls.writing(pipe, instance.dict())
+                    pipe.sadd(cls.voters_key(instance.key), instance.creator_id)
+                    pipe.execute()
+            await as_async(adding)()
             return EitherErrorOrOk(ok=instance.key, ok_msg="Thanks for voting!")
         return EitherErrorOrOk(error=f"Unable to add this key {instance.key}, as the same exists already.")
 
@@ -39,26 +162,45 @@ class Suggestions:
         def removing(key: str) -> None:
             item = cls.container[key]
             if datetime.now() - datetime.fromtimestamp(item["created"]) < timedelta(days=1):
-                cls.container.__delitem__(key)
+                with RedisPool(pipeline=True) as pipe:
+                    pipe.hdel(cls.container.key, cls.container._encode(key))
+                    pipe.zrem(cls.scores_key, key)
+                    pipe.delete(cls.voters_key(key))
+                    pipe.execute()
         return await as_async(removing)(key)
 
     @classmethod
     async def cast_vote(cls, voter_id: str, key: str, vote: int) -> EitherErrorOrOk:
-        def voting(key: str, voter_id: str, vote: int):
-            item = cls.container[key]
-            if voter_id in item["voters_ids"]:
-                return
-            if vote == 1:
-                item["votesFor"] += 1
-            else:
-                item["votesAgainst"] += 1
-            item["score"] = cls.make_score(
-                _for=item["votesFor"], _against=item["votesAgainst"])
-            item["voters_ids"].append(voter_id)
-            cls.container[key] = item
-        if key in cls.container:
-            await as_async(voting)(key, voter_id, vote)
+        """ A single round trip, O(log(n)) whatever the number of voters, and safe under concurrent votes. """
+        voted = await as_async(cls.voting)(keys=cls.vote_keys(key), args=[cls.container._encode(key), key, voter_id, vote])
+        return cls.vote_result(voted, voter_id, key)
+
+    # how many votes are sent per pipeline by 'cast_votes'
+    vote_batch_size = 500
+
+    @classmethod
+    async def cast_votes(cls, votes: List[Vote]) -> List[EitherErrorOrOk]:
+        """ Bulk version of 'cast_vote', running the voting script 'vote_batch_size' votes per round trip. One result per vote, in order. """
+        def voting_many(batch: List[Suggestions.Vote]) -> List[int]:
+            with RedisPool(pipeline=True) as pipe:
+                for v in batch:
+                    cls.voting(keys=cls.vote_keys(v.sugg_id), args=[
+                               cls.container._encode(v.sugg_id), v.sugg_id, v.voter_id, v.vote], client=pipe)
+                return pipe.execute()
+
+        results = []
+        for n in range(0, len(votes), cls.vote_batch_size):
+            batch = votes[n:n + cls.vote_batch_size]
+            voted = await as_async(voting_many)(batch)
+            results += [cls.vote_result(code, v.voter_id, v.sugg_id) for code, v in zip(voted, batch)]
+        return results
+
+    @staticmethod
+    def vote_result(voted: int, voter_id: str, key: str) -> EitherErrorOrOk:
+        if voted == 1:
             return EitherErrorOrOk(ok=f"Thanks for voting for {key}")
+        if voted == 0:
+            return EitherErrorOrOk(error=f"{voter_id} voted for {key} already!")
         return EitherErrorOrOk(error=f"You tried to vote for {key}, which is not a valid key!")
 
     def __init__(
@@ -69,7 +211,7 @@ class Suggestions:
         start_datetime: Optional[str] = None,
         end_datetime: Optional[str] = None
     ) -> None:
-        self.key = str(abs(hash(title)))
+        self.key = stable_digest(title)
         self.title = title
         self.description = description
         self.creator_id = creator_id
@@ -77,8 +219,7 @@ class Suggestions:
             self.end_datetime = end_datetime
         self.votesFor: int = 1
         self.votesAgainst: int = 0
-        self.score: float = 0
-        self.voters_ids: List[str] = [creator_id]
+        self.score: float = self.make_score(self.votesFor, self.votesAgainst)
         self.created: float = datetime.now().timestamp()
         self.start_datetime: str = start_datetime or datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
@@ -87,25 +228,34 @@ class Suggestions:
 
     @staticmethod
     def make_score(_for: int, _against: int) -> float:
-        """ aka lower bound of Wilson score confidence interval for a Bernoulli parameter """
-        left = (_for + 1.9208) / (_for + _against)
+        """ aka lower bound of Wilson score confidence interval for a Bernoulli parameter, as computed by the 'voting' script """
+        left = (_for + 1.9208) / (_for + _against) / (1 + 3.8416 / (_for + _against))
         right = 1.96 * sqrt((_for * _against) / (_for + _against) + 0.9604) / \
             (_for + _against) / (1 + 3.8416 / (_for + _against))
         return round(left - right, 3)
 
+    @classmethod
+    def top(cls, offset: int = 0, limit: int = 50) -> List[Dict[str, Any]]:
+        """ The page of suggestions by descending score, fetching only these from the container. """
+        cls.load_scores()
+        with RedisPool() as conn:
+            keys = conn.zrevrange(cls.scores_key, offset, offset + limit - 1)
+            values = conn.hmget(cls.container.key, [cls.container._encode(k.decode("utf-8")) for k in keys]) if keys else []
+        return [cls.container._decode(v) for v in values if v]
+
     @staticmethod
-    async def view(key: Optional[str] = None) -> EitherErrorOrOk:
+    async def view(key: Optional[str] = None, offset: int = 0, limit: int = 50) -> EitherErrorOrOk:
         if not key:
-            return EitherErrorOrOk(ok=await as_async(lambda: sorted(Suggestions.container.values(), key=lambda i: i["score"], reverse=True))())
+            return EitherErrorOrOk(ok=await as_async(Suggestions.top)(offset, limit))
         if key and not key in Suggestions.container:
             return EitherErrorOrOk(error=f"You were looking for this key {key} but it could not be found!")
         return EitherErrorOrOk(ok=await as_async(lambda: Suggestions.container[key])())
 
 
 @app.get(f"/{__MODULE_NAME__}/")
-async def get_suggestions(key: Optional[str] = None) -> QueryResponse:
+async def get_suggestions(key: Optional[str] = None, offset: int = 0, limit: int = 50) -> QueryResponse:
     query = Query(service=__MODULE_NAME__)
-    results = await Suggestions.view(key)
+    results = await Suggestions.view(key, max(offset, 0), min(max(limit, 1), 500))
     if ok := results.is_ok():
         return QueryResponse(query=query, results=results, results_count=len(ok))
     return QueryResponse(query=query, error=str(ok))
@@ -127,3 +277,11 @@ async def vote_for_suggestion(voter_id: str, sugg_id: str, vote: int) -> QueryRe
     if result.is_ok():
         return QueryResponse(query=query, message="Thanks!")
     return QueryResponse(query=query, error=result.error)
+
+
+@app.post(f"/{__MODULE_NAME__}/vote_for_suggestions/")
+async def vote_for_suggestions(votes: List[Suggestions.Vote]) -> QueryResponse:
+    query = Query(service=__MODULE_NAME__)
+    results = [r.dict() for r in await Suggestions.cast_votes(votes)]
+    counted = len([r for r in results if "ok" in r])
+    return QueryResponse(query=query, message=f"Counted {counted} out of {len(results)} votes", results=results, results_count=len(results))
@@ -1,5 +1,5 @@
 from collections import deque
-from defrag.modules.helpers.data_manipulation import compose, find_first, make_xform, make_transducer, base_step, dropwhile_takeif
+from defrag.modules.helpers.data_manipulation import compose, find_first, make_xform, make_transducer, base_step, dropwhile_takeif, stable_digest
 from random import randint
 
 def test_compose():
@@ -65,3 +65,8 @@ def test_dropwhile_takeif():
     tc = lambda x: x % 2 == 0
     assert list(dropwhile_takeif(l, dc, tc)) == [4,6,8,10]
 
+
+def test_stable_digest():
+    assert stable_digest({"a": 1, "b": [1, 2]}) == stable_digest({"b": [1, 2], "a": 1})
+    assert stable_digest({"a": 1}) != stable_digest({"a": 2})
+    assert len(stable_digest("title")) == 32
@@ -1,6 +1,7 @@
 from defrag.modules.db.redis import RedisPool
 from defrag import app
-from defrag.modules.dispatcher import Dispatcher, Dispatchable, EmailNotification
+from defrag.modules.dispatcher import Destination, Dispatcher, Dispatchable, EmailNotification, TopicSubscription
+from defrag.modules.helpers.queues import MemoryQueue, RedisStreamQueue
 from fastapi.testclient import TestClient
 from datetime import datetime, timedelta
 import pytest
@@ -26,13 +27,57 @@ async def test_Dispatcher():
         f"Scheduled: {len(Dispatcher.scheduled)}, Available for polling: {len(Dispatcher.due_for_polling_notifications)}")
     assert len(Dispatcher.due_for_polling_notifications) == 3
     assert not Dispatcher.scheduled
+    Dispatcher.stop()
+
+
+@pytest.mark.asyncio
+async def test_Dispatcher_stream_queue():
+    with RedisPool() as conn:
+        conn.flushall()
+    now = datetime.now()
+    notification = EmailNotification(
+        poll_do_not_push=True, body="some contents", email_address="to someone", email_object="about something")
+    dispatchables = [Dispatchable(
+        id=k, origin="test client", notification=notification, schedules=[(now + timedelta(days=1)).timestamp()]) for k in range(0, 3)]
+    queue = RedisStreamQueue(block_ms=100)
+    Dispatcher.run(seconds=60, queue=queue)
+    await asyncio.gather(*[Dispatcher.put(d) for d in dispatchables])
+    await asyncio.sleep(2)
+    Dispatcher.stop()
+    with RedisPool() as conn:
+        pending = [conn.xpending(stream, queue.group) for stream in queue.streams.values()]
+    assert len(Dispatcher.scheduled) == 3
+    assert not any(p["pending"] for p in pending)
+
+
+def test_item_ids():
+    notification = EmailNotification(poll_do_not_push=True, body="same contents", email_address="someone", email_object="same object")
+    ids = {Dispatcher.as_item(Dispatchable(origin=origin, notification=notification, schedules=schedules))["id"]
+           for origin, schedules in [("reminders", [1.0]), ("reminders", [2.0]), ("calendar", [1.0])]}
+    assert len(ids) == 3
+    assert Dispatcher.as_item(Dispatchable(origin="reminders", notification=notification, schedules=[2.0, 1.0]))["id"] == \
+        Dispatcher.as_item(Dispatchable(origin="reminders", notification=notification, schedules=[1.0, 2.0]))["id"]
+
+
+@pytest.mark.asyncio
+async def test_reclaim():
+    with RedisPool() as conn:
+        conn.flushall()
+    queue = RedisStreamQueue(block_ms=100, claim_idle_ms=100)
+    queue.ensure_groups()
+    for n in range(3):
+        await queue.put({"n": n}, "bulk")
+    # left unacknowledged, as when processing fails
+    taken = [(await queue.get())[1]["n"] for _ in range(3)]
+    await asyncio.sleep(0.2)
+    retaken = [(await queue.get())[1]["n"] for _ in range(3)]
+    assert taken == retaken == [0, 1, 2]
 
 
 @pytest.mark.asyncio
 async def test_poll_due():
     with RedisPool() as conn:
         conn.flushall()
-    yesterday = (datetime.now() - timedelta(days=1)).timestamp()
     notifiers = [Dispatchable(origin="test", notification=EmailNotification(
         dispatched=datetime.now().timestamp(),
         poll_do_not_push=True,
@@ -41,8 +86,121 @@ async def test_poll_due():
         email_object="about something"
     )).dict() for _ in range(0, 10)
     ]
-    Dispatcher.due_for_polling_notifications.extendleft(notifiers)
-    Dispatcher.due_last_poll = yesterday
-    polled = await Dispatcher.poll_due(True)
-    print(list(Dispatcher.due_for_polling_notifications))
+    await Dispatcher.subscribe_poller("first")
+    await Dispatcher.subscribe_poller("second")
+    Dispatcher.due_for_polling_notifications.extend(notifiers)
+    polled = await Dispatcher.poll_due(True, poller_id="first")
     assert len(polled) == len(notifiers)
+    assert not await Dispatcher.poll_due(True, poller_id="first")
+    assert len(Dispatcher.due_for_polling_notifications) == len(notifiers)
+    polled = await Dispatcher.poll_due(True, poller_id="second")
+    assert len(polled) == len(notifiers)
+    assert len(Dispatcher.due_for_polling_notifications) == 1
+
+
+@pytest.mark.asyncio
+async def test_long_poll_due():
+    with RedisPool() as conn:
+        conn.flushall()
+    Dispatcher.run(seconds=60)
+    await asyncio.sleep(0.5)
+    notification = EmailNotification(
+        poll_do_not_push=True, body="some contents", email_address="to someone", email_object="about something")
+    polling = asyncio.create_task(Dispatcher.poll_due(False, timeout=10))
+    await asyncio.sleep(0.5)
+    assert not polling.done()
+    await Dispatcher.put(Dispatchable(id="now", origin="test client", notification=notification))
+    polled = await asyncio.wait_for(polling, timeout=5)
+    Dispatcher.stop()
+    assert len(polled) == 1
+
+
+@pytest.mark.asyncio
+async def test_unschedule():
+    with RedisPool() as conn:
+        conn.flushall()
+    notification = EmailNotification(
+        poll_do_not_push=True, body="some contents", email_address="to someone", email_object="about something")
+    tomorrow = (datetime.now() + timedelta(days=1)).timestamp()
+    for k in range(0, 3):
+        Dispatcher.schedule(Dispatchable(id=str(k), origin="test client", notification=notification, schedules=[tomorrow]).dict())
+    assert await Dispatcher.unschedule("1")
+    assert not await Dispatcher.unschedule("1")
+    assert len(Dispatcher.scheduled) == 2
+    assert not Dispatcher.due_items(tomorrow - 1)
+    assert len(Dispatcher.due_items(tomorrow)) == 2
+
+
+def test_occurrences():
+    with RedisPool() as conn:
+        conn.flushall()
+    notification = EmailNotification(
+        poll_do_not_push=True, body="some contents", email_address="to someone", email_object="about something")
+    tomorrow = (datetime.now() + timedelta(days=1)).timestamp()
+    schedules = [tomorrow + n * 3600 for n in range(0, 3)]
+    Dispatcher.schedule(Dispatchable(id="weekly", origin="test client", notification=notification, schedules=schedules).dict())
+    due = Dispatcher.due_items(tomorrow + 3600)
+    assert [i["schedules"] for i in due] == [[schedules[0]], [schedules[1]]]
+    for i in due:
+        Dispatcher.consume(i["id"], i["schedules"][-1])
+    assert len(Dispatcher.scheduled) == 1
+    assert not Dispatcher.due_items(tomorrow + 3600)
+    Dispatcher.consume("weekly", schedules[2])
+    assert not Dispatcher.scheduled
+
+
+@pytest.mark.asyncio
+async def test_dead_letters():
+    with RedisPool() as conn:
+        conn.flushall()
+    notification = EmailNotification(
+        poll_do_not_push=True, body="some contents", email_address="to someone", email_object="about something")
+    for k in range(0, 3):
+        item = Dispatchable(id=str(k), origin="test client", notification=notification, retries=3).dict()
+        Dispatcher.dead_letters.append({"item": item, "error": "status code 502", "dead_at": datetime.now().timestamp()})
+    first_page = await Dispatcher.list_dead_letters(limit=2)
+    second_page = await Dispatcher.list_dead_letters(after=first_page[-1]["id"], limit=2)
+    assert len(first_page) == 2 and len(second_page) == 1
+    Dispatcher.run(seconds=60)
+    # overlapping replays share the letters rather than replaying them twice
+    replayed = await asyncio.gather(*[Dispatcher.replay_dead_letters(limit=10, rate=100) for _ in range(2)])
+    assert sum(replayed) == 3
+    await asyncio.sleep(1)
+    Dispatcher.stop()
+    assert not len(Dispatcher.dead_letters)
+    assert len(Dispatcher.due_for_polling_notifications) == 3
+
+
+@pytest.mark.asyncio
+async def test_priority_lanes():
+    queue = MemoryQueue()
+    for n in range(0, 10):
+        await queue.put({"id": f"bulk{n}"}, "bulk")
+    for n in range(0, 2):
+        await queue.put({"id": f"immediate{n}"}, "immediate")
+    first = [(await queue.get())[1]["id"] for _ in range(0, 3)]
+    assert first[:2] == ["immediate0", "immediate1"]
+    assert first[2] == "bulk0"
+
+
+@pytest.mark.asyncio
+async def test_topics():
+    with RedisPool() as conn:
+        conn.flushall()
+    for n in range(0, 3):
+        await Dispatcher.subscribe_to_topic(TopicSubscription(
+            topic="releases", subscriber_id=f"bot{n}", destination=Destination(bot_endpoint=f"http://bot{n}", chat_id=n)))
+    assert await Dispatcher.unsubscribe_from_topic("releases", "bot0")
+    assert not await Dispatcher.unsubscribe_from_topic("releases", "bot0")
+    cursor, destinations = Dispatcher.topic_page("releases")
+    assert cursor == 0
+    assert destinations == {"bot1": {"bot_endpoint": "http://bot1", "chat_id": 1},
+                            "bot2": {"bot_endpoint": "http://bot2", "chat_id": 2}}
+    notification = EmailNotification(body="some contents", poll_do_not_push=False, email_address="nobody", email_object="about something")
+    item = Dispatchable(origin="test client", notification=notification, topic="releases").dict()
+    item["id"] = "release"
+    Dispatcher.process_q = MemoryQueue()
+    await Dispatcher.dispatch([item])
+    copies = [c for lane in Dispatcher.process_q.lanes.values() for c in lane]
+    assert sorted(c["id"] for c in copies) == ["release:bot1", "release:bot2"]
+    assert not any(c["topic"] for c in copies)
@@ -0,0 +1,67 @@
+from defrag.modules.db.redis import RedisPool
+from defrag.modules.helpers.intervals import IntervalIndex, RedisIntervalIndex, WindowCache
+import asyncio
+import pytest
+
+
+def test_overlapping():
+    index = IntervalIndex()
+    index.update([("short", 10, 11), ("long", 0, 100), ("later", 50, 60), ("gone", 20, 30)])
+    index.remove("gone")
+    assert index.overlapping(40, 55) == ["long", "later"]
+    assert index.overlapping(12, 20) == ["long"]
+    assert index.overlapping(101, 200) == []
+    index.add("long", 0, 5)
+    assert index.overlapping(40, 55) == ["later"]
+    assert len(index) == 3 and "gone" not in index
+    index.add("forever", 55, float("inf"))
+    assert index.overlapping(1000, 2000) == ["forever"]
+    assert index.overlapping(40, 55) == ["later", "forever"]
+
+
+@pytest.mark.asyncio
+async def test_redis_overlapping():
+    with RedisPool() as conn:
+        conn.flushall()
+    index = RedisIntervalIndex("test_index")
+    with RedisPool(pipeline=True) as pipe:
+        for _id, start, end in [("short", 10, 11), ("long", 0, 100), ("later", 50, 60), ("forever", 55, float("inf"))]:
+            index.add(pipe, _id, start, end)
+        pipe.execute()
+    assert index.overlapping(40, 55) == ["long", "later", "forever"]
+    assert index.overlapping(101, 200) == ["forever"]
+    assert index.contains(["short", "gone"]) == [True, False]
+    mirroring = asyncio.create_task(index.mirror())
+    await asyncio.sleep(1)
+    assert index.overlapping(40, 55) == ["long", "later", "forever"]
+    local = index.local
+    with RedisPool(pipeline=True) as pipe:
+        index.remove(pipe, "long")
+        index.add(pipe, "new", 45, 46)
+        pipe.execute()
+    await asyncio.sleep(1)
+    assert index.changed == {"long", "new"}
+    assert index.overlapping(40, 55) == ["new", "later", "forever"]
+    # refreshed in place rather than reloaded
+    assert index.local is local and not index.changed
+    mirroring.cancel()
+    await asyncio.sleep(0.1)
+    assert index.local is None
+
+
+def test_window_cache():
+    with RedisPool() as conn:
+        conn.flushall()
+    cache, writer = WindowCache("test_windows", max_windows=3), WindowCache("test_windows")
+    for key, lo, hi in [("week", 0, 7), ("month", 0, 30), ("next month", 30, 60)]:
+        assert cache.get(key) is None
+        cache.put(key, lo, hi, [key])
+    assert cache.get("week") == ["week"]
+    with RedisPool(pipeline=True) as pipe:
+        writer.changing(pipe, 10, float("inf"))
+        pipe.execute()
+    assert cache.get("month") is None and cache.get("next month") is None
+    assert cache.get("week") == ["week"]
+    for n in range(3):
+        cache.put(f"day {n}", n, n + 1, [n])
+    assert len(cache) == 3 and cache.get("week") is None
@@ -0,0 +1,56 @@
+from defrag.modules.db.redis import RedisPool
+from defrag.modules.helpers.leader_election import LeaderElection, LeaseLock
+import asyncio
+import pytest
+
+
+def test_lease_lock():
+    with RedisPool() as conn:
+        conn.flushall()
+    first, second = LeaseLock("test_lease"), LeaseLock("test_lease")
+    assert first.acquire()
+    assert not second.acquire()
+    assert first.renew() and first.is_valid()
+    first_token = first.token
+    first.release()
+    assert second.acquire()
+    assert second.token > first_token
+    assert not first.renew()
+
+
+@pytest.mark.asyncio
+async def test_leader_election():
+    with RedisPool() as conn:
+        conn.flushall()
+    ran = []
+
+    async def job():
+        ran.append(True)
+    leader = LeaderElection(LeaseLock("test_election", ttl_ms=600), {"job": job})
+    standby = LeaderElection(LeaseLock("test_election", ttl_ms=600), {"job": job})
+    tasks = [asyncio.create_task(e.campaign()) for e in [leader, standby]]
+    await asyncio.sleep(0.5)
+    assert leader.is_leader != standby.is_leader
+    assert len(ran) == 1
+    for t in tasks:
+        t.cancel()
+    for e in [leader, standby]:
+        e.resign()
+
+
+@pytest.mark.asyncio
+async def test_revive_jobs():
+    with RedisPool() as conn:
+        conn.flushall()
+    ran = []
+
+    async def flaky():
+        ran.append(True)
+        if len(ran) == 1:
+            raise Exception("first run fails")
+    leader = LeaderElection(LeaseLock("test_revive", ttl_ms=600), {"flaky": flaky})
+    task = asyncio.create_task(leader.campaign())
+    await asyncio.sleep(0.7)
+    assert leader.is_leader and len(ran) == 2
+    task.cancel()
+    leader.resign()
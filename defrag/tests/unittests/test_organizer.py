@@ -4,8 +4,8 @@ from defrag.modules.db.redis import RedisPool
 from itertools import count
 from random import randint
 from typing import Any, Generator, Optional
-from defrag.modules.dispatcher import EmailNotification, Dispatcher
-from defrag.modules.organizer import Calendar, CustomEvent, FedocalEvent, Reminders, FORMAT, Rrule, get_calendar, post_cancel_event, post_events, post_reminders, post_fedocal_events, post_reminders_for
+from defrag.modules.dispatcher import Destination, EmailNotification, Dispatcher
+from defrag.modules.organizer import Calendar, CustomEvent, EventSubscription, FedocalEvent, Reminders, FORMAT, Rrule, event_rule, occurs_within, stamped, get_calendar, get_calendar_ics, post_cancel_event, post_events, post_reminders, post_fedocal_events, post_reminders_for
 from defrag.modules.organizer import Reminders
 import pytest
 
@@ -25,20 +25,21 @@ def reminders_factory(with_tgt: Optional[bool] = False) -> Generator[Reminders,
 
 
 def meetings_factory() -> Generator[CustomEvent, Any, Any]:
-    for n in count(start=0, step=1):
+    today = datetime.now().replace(hour=8, minute=0, second=0, microsecond=0)
+    for n in count(start=1, step=1):
         yield CustomEvent(
             id=randint(1, 10000),
             title="some title",
             manager="manager name",
             creator="creator name",
             created=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            start=f"2021-10-1{n} 08:00:00",
-            end=f"2021-10-1{n+1} 09:00:00",
+            start=(today + timedelta(days=n)).strftime(FORMAT),
+            end=(today + timedelta(days=n, hours=1)).strftime(FORMAT),
             description="some description",
             location="openSUSE jitsi meet",
             tags=["defrag", "onboarding", "knowledge transfer"],
             restricted=[],
-            rrule=Rrule(freq="weekly", until="2021-12-31 08:00:00")
+            rrule=Rrule(freq="weekly", until=(today + timedelta(days=365)).strftime(FORMAT))
         )
 
 
@@ -62,7 +63,6 @@ def fedocal_meetings_factory() -> Generator[FedocalEvent, Any, Any]:
 async def test_reminders():
     with RedisPool() as conn:
         conn.flushall()
-    Calendar.viewer = {}
     Dispatcher.run(60)
     item = next(reminders_factory())
     item.tgt = datetime.now().strftime(FORMAT)
@@ -77,7 +77,6 @@ async def test_reminders():
 async def test_add_fedocal_meetings():
     with RedisPool() as conn:
         conn.flushall()
-    Calendar.viewer = {}
     Dispatcher.run(60)
     meetings_f, reminders_f = fedocal_meetings_factory(), reminders_factory()
     meetings = [next(meetings_f) for _ in range(0, 3)]
@@ -93,7 +92,6 @@ async def test_add_fedocal_meetings():
 async def test_add_meetings():
     with RedisPool() as conn:
         conn.flushall()
-    Calendar.viewer = {}
     Dispatcher.run(60)
     meetings_f, reminders_f = meetings_factory(), reminders_factory()
     meetings = [next(meetings_f) for _ in range(0, 3)]
@@ -108,7 +106,6 @@ async def test_add_meetings():
 async def test_cancel_meeting():
     with RedisPool() as conn:
         conn.flushall()
-    Calendar.viewer = {}
     Dispatcher.run(60)
     meetings_f, reminders_f = meetings_factory(), reminders_factory()
     meetings = [next(meetings_f) for _ in range(0, 3)]
@@ -117,22 +114,41 @@ async def test_cancel_meeting():
     print(response)
     cancellable_id = response.results[randint(0, 2)]
     response = await post_cancel_event(cancellable_id)
-    start, end = "2021-10-10 08:00:00", "2021-12-30 00:00:00"
+    start, end = datetime.now().strftime(FORMAT), (datetime.now() + timedelta(days=30)).strftime(FORMAT)
     res = await get_calendar(start, end)
     Dispatcher.stop()
     assert res.results_count == 2
 
+@pytest.mark.asyncio
+async def test_render_cache():
+    with RedisPool() as conn:
+        conn.flushall()
+    meetings_f = meetings_factory()
+    response = await post_events([next(meetings_f) for _ in range(0, 3)], next(reminders_factory()))
+    start, end = datetime.now().strftime(FORMAT), (datetime.now() + timedelta(days=30)).strftime(FORMAT)
+    first = await Calendar.render(start, end)
+    assert await Calendar.render(start, end) is first
+    await Calendar.cancel(response.results[0])
+    assert len(await Calendar.render(start, end)) == 2
+    # writes out of the window leave it cached
+    later = next(meetings_f)
+    later.rrule = None
+    later.start, later.end = (datetime.now() + timedelta(days=60)).strftime(FORMAT), (datetime.now() + timedelta(days=61)).strftime(FORMAT)
+    second = await Calendar.render(start, end)
+    await post_events([later], next(reminders_factory()))
+    assert await Calendar.render(start, end) is second
+
+
 @pytest.mark.asyncio
 async def test_get_calendar():
     with RedisPool() as conn:
         conn.flushall()
-    Calendar.viewer = {}
     Dispatcher.run(60)
     meetings_f, reminders_f = meetings_factory(), reminders_factory()
     meetings = [next(meetings_f) for _ in range(0, 3)]
     reminders = next(reminders_f)
     res = await post_events(meetings, reminders)
-    start, end = "2021-10-10 08:00:00", "2021-12-30 00:00:00"
+    start, end = datetime.now().strftime(FORMAT), (datetime.now() + timedelta(days=30)).strftime(FORMAT)
     res = await get_calendar(start, end)
     print(f"The calendar currently holds {res.results_count} items.")
     Dispatcher.stop()
@@ -142,15 +158,226 @@ async def test_get_calendar():
 async def test_set_reminders_for():
     with RedisPool() as conn:
         conn.flushall()
-    Calendar.viewer = {}
     Dispatcher.run(60)
     meeting = next(meetings_factory())
     reminders = next(reminders_factory())
     response = await post_events([meeting], reminders)
     event_id = response.results[0]
-    res = await post_reminders_for(event_id, reminders)
+    subscription = EventSubscription(subscriber_id="some user", destination=Destination(chat_id=1), deltas=reminders.deltas)
+    res = await post_reminders_for(event_id, subscription)
     print(f"Results: {res}")
     await asyncio.sleep(1)
     print(f"Dispatched: {Dispatcher.scheduled}")
     assert len(list(Dispatcher.scheduled)) == 2
-    Dispatcher.stop()
\ No newline at end of file
+    Dispatcher.stop()
+
+
+@pytest.mark.asyncio
+async def test_reminder_subscriptions():
+    with RedisPool() as conn:
+        conn.flushall()
+    meeting = next(meetings_factory())
+    response = await post_events([meeting], next(reminders_factory()))
+    event_id = response.results[0]
+    deltas = Reminders.UserDeltas(days=1, hours=1)
+    for n in range(3):
+        subscription = EventSubscription(subscriber_id=f"user {n}", destination=Destination(chat_id=n), deltas=deltas)
+        assert hasattr(await Calendar.subscribe(event_id, subscription), "ok")
+    # one scheduled item per distinct offset, whatever the number of subscribers
+    topics = [Calendar.reminder_topic(event_id, 86400), Calendar.reminder_topic(event_id, 3600)]
+    assert all(t in Dispatcher.scheduled for t in topics)
+    assert len(Dispatcher.scheduled) == 3
+    with RedisPool() as conn:
+        assert conn.hlen(Dispatcher.topic_key(topics[0])) == 3
+    assert await Calendar.unsubscribe(event_id, "user 0")
+    assert not await Calendar.unsubscribe(event_id, "user 0")
+    # concurrent unsubscriptions and subscriptions on the same offsets keep it scheduled as long as anyone subscribes
+    await asyncio.gather(Calendar.unsubscribe(event_id, "user 1"), Calendar.unsubscribe(event_id, "user 2"),
+                         Calendar.subscribe(event_id, EventSubscription(subscriber_id="user 3", destination=Destination(chat_id=3), deltas=deltas)))
+    assert all(t in Dispatcher.scheduled for t in topics)
+    with RedisPool() as conn:
+        assert conn.hgetall(Calendar.offsets_key(event_id)) == {b"86400": b"1", b"3600": b"1"}
+    await Calendar.cancel(event_id)
+    assert len(Dispatcher.scheduled) == 0
+    with RedisPool() as conn:
+        assert not conn.exists(Dispatcher.topic_key(topics[0]), Calendar.subscriptions_key(event_id), Calendar.offsets_key(event_id))
+        assert conn.exists(Calendar.cancelled_key(event_id))
+    # cancelled events take no subscriptions, even racing with their cancellation
+    assert not hasattr(await Calendar.subscribe(event_id, subscription), "ok")
+    assert Calendar.subscribing(event_id, "user 4", Destination(chat_id=4), [3600.0]) is None
+    with RedisPool() as conn:
+        assert not conn.exists(Calendar.subscriptions_key(event_id), Calendar.offsets_key(event_id))
+
+@pytest.mark.asyncio
+async def test_extend_horizons():
+    with RedisPool() as conn:
+        conn.flushall()
+    Dispatcher.run(60)
+    meeting = next(meetings_factory())
+    meeting.rrule = Rrule(freq="daily", until=(datetime.now() + timedelta(days=365)).strftime(FORMAT))
+    response = await post_events([meeting], next(reminders_factory()))
+    event_id = response.results[0]
+    await asyncio.sleep(1)
+    first = Calendar.container[event_id]
+    assert len(first["rruled_occurrences"]) == 10
+    Calendar.extend_horizon(event_id)
+    second = Calendar.container[event_id]
+    assert second["rruled_occurrences"][0] > first["horizon"]
+    assert len(second["rruled_occurrences"]) == 10
+    with RedisPool() as conn:
+        assert conn.scard(f"scheduled_items_occurrences_{event_id}") == 20
+    Dispatcher.stop()
+
+
+@pytest.mark.asyncio
+async def test_subscribe_after_extension():
+    with RedisPool() as conn:
+        conn.flushall()
+    meeting = next(meetings_factory())
+    meeting.rrule = Rrule(freq="daily", until=(datetime.now() + timedelta(days=365)).strftime(FORMAT))
+    response = await post_events([meeting], next(reminders_factory()))
+    event_id = response.results[0]
+    Calendar.extend_horizon(event_id)
+    subscription = EventSubscription(subscriber_id="late user", destination=Destination(chat_id=1), deltas=Reminders.UserDeltas(hours=1))
+    assert hasattr(await Calendar.subscribe(event_id, subscription), "ok")
+    # both windows, not only the latest one
+    with RedisPool() as conn:
+        assert conn.scard(Dispatcher.schedule_keys(Calendar.reminder_topic(event_id, 3600))[2]) == 20
+
+
+def test_distant_start():
+    meeting = next(meetings_factory())
+    start = datetime.now().replace(microsecond=0) + timedelta(days=73)
+    meeting.start, meeting.end = start.strftime(FORMAT), (start + timedelta(hours=1)).strftime(FORMAT)
+    meeting.rrule = Rrule(freq="daily", until=(start + timedelta(days=365)).strftime(FORMAT))
+    occurrences, horizon = meeting.apply_rrule(after=start, inc=True)
+    assert not occurrences and horizon < start
+    # the window reaching the start does not skip it
+    later, _ = meeting.apply_rrule(after=horizon, days=100)
+    assert later[0] == start
+
+
+def test_full_rrule():
+    rule = Rrule(freq="monthly", count=3, byweekday=["-1fr"], byhour=[8, 18])
+    assert rule.to_rfc() == "FREQ=MONTHLY;COUNT=3;BYDAY=-1FR;BYHOUR=8,18"
+    meeting = next(meetings_factory())
+    meeting.start, meeting.end, meeting.rrule = "2021-10-01 08:00:00", "2021-10-01 09:00:00", rule
+    assert meeting.rule() is meeting.rule()
+    assert [d.strftime(FORMAT) for d in meeting.rule()] == [
+        "2021-10-29 08:00:00", "2021-10-29 18:00:00", "2021-11-26 08:00:00"]
+    assert meeting.last_occurrence().strftime(FORMAT) == "2021-11-26 08:00:00"
+    meeting.stamp()
+    assert occurs_within(meeting.dict(), datetime(2021, 11, 26, 8, 30), datetime(2021, 11, 27))
+    assert not occurs_within(meeting.dict(), datetime(2021, 11, 1), datetime(2021, 11, 20))
+    meeting.rrule = Rrule(freq="minutely", count=10 ** 6)
+    with pytest.raises(ValueError):
+        meeting.rule()
+
+
+@pytest.mark.asyncio
+async def test_sync_fedocal(monkeypatch):
+    with RedisPool() as conn:
+        conn.flushall()
+    Dispatcher.run(60)
+    meetings_f = fedocal_meetings_factory()
+    meetings = [next(meetings_f) for _ in range(0, 3)]
+    for n, m in enumerate(meetings):
+        m.event_id = n
+        m.event_date = m.event_date_end = (datetime.now() + timedelta(days=n + 2)).strftime("%Y-%m-%d")
+
+    async def poll_fedocal(interval=None, start=None):
+        return [m.copy() for m in meetings]
+    monkeypatch.setattr(Calendar, "poll_fedocal", poll_fedocal)
+
+    assert await Calendar.sync_fedocal() == {"added": 3, "updated": 0, "cancelled": 0}
+    assert await Calendar.sync_fedocal() == {"added": 0, "updated": 0, "cancelled": 0}
+    meetings[0].event_information = "moved to another room"
+    meetings.pop()
+    assert await Calendar.sync_fedocal() == {"added": 0, "updated": 1, "cancelled": 1}
+    await asyncio.sleep(1)
+    statuses = sorted(e["status"] for e in Calendar.container.values())
+    assert statuses == ["active", "active", "cancelled"]
+    assert len(Dispatcher.scheduled) == 2
+    Dispatcher.stop()
+
+
+@pytest.mark.asyncio
+async def test_sync_simultaneous_fedocal(monkeypatch):
+    with RedisPool() as conn:
+        conn.flushall()
+    Dispatcher.run(60)
+    meetings_f = fedocal_meetings_factory()
+    meetings = [next(meetings_f) for _ in range(0, 2)]
+    for n, m in enumerate(meetings):
+        m.event_id = n
+        m.event_date = m.event_date_end = (datetime.now() + timedelta(days=2)).strftime("%Y-%m-%d")
+
+    async def poll_fedocal(interval=None, start=None):
+        return [m.copy() for m in meetings]
+    monkeypatch.setattr(Calendar, "poll_fedocal", poll_fedocal)
+
+    assert await Calendar.sync_fedocal() == {"added": 2, "updated": 0, "cancelled": 0}
+    assert len(Calendar.container) == 2
+    meetings.pop()
+    assert await Calendar.sync_fedocal() == {"added": 0, "updated": 0, "cancelled": 1}
+    statuses = sorted(e["status"] for e in Calendar.container.values())
+    assert statuses == ["active", "cancelled"]
+    Dispatcher.stop()
+
+
+@pytest.mark.asyncio
+async def test_export_ics():
+    with RedisPool() as conn:
+        conn.flushall()
+    Dispatcher.run(60)
+    meetings_f, reminders_f = meetings_factory(), reminders_factory()
+    await post_events([next(meetings_f) for _ in range(0, 3)], next(reminders_f))
+    response = await get_calendar_ics()
+    etag = response.headers["etag"]
+    feed = "".join([chunk async for chunk in response.body_iterator])
+    assert feed.startswith("BEGIN:VCALENDAR\r\n") and feed.endswith("END:VCALENDAR\r\n")
+    assert feed.count("BEGIN:VEVENT") == 3 and feed.count("RRULE:FREQ=WEEKLY;UNTIL=") == 3
+    assert "".join([chunk async for chunk in Calendar.export_ics(etag.strip('"'))]) == feed
+    assert (await get_calendar_ics(if_none_match=etag)).status_code == 304
+    await post_events([next(meetings_f)], next(reminders_f))
+    assert (await get_calendar_ics(if_none_match=etag)).status_code == 200
+    Dispatcher.stop()
+
+
+@pytest.mark.asyncio
+async def test_add_many():
+    with RedisPool() as conn:
+        conn.flushall()
+    meetings_f, reminders = meetings_factory(), next(reminders_factory())
+    meetings = [next(meetings_f) for _ in range(0, 3)]
+    invalid = next(meetings_f)
+    invalid.rrule = Rrule(freq="fortnightly")
+    results = await Calendar.add_many([*meetings, meetings[0].copy(), invalid], reminders.notification, reminders.deltas)
+    assert len(results.successes) == 3 and len(results.failures) == 2
+    assert len(Calendar.container) == 3 and len(Dispatcher.scheduled) == 3
+    again = await Calendar.add_many([meetings[1]], reminders.notification, reminders.deltas)
+    assert not again.successes
+
+
+def test_stamped():
+    meeting = next(meetings_factory())
+    meeting.rrule = Rrule(freq="weekly", count=3)
+    # as stored before the stamps were
+    event = stamped(meeting.dict())
+    assert event["start_ts"] == datetime.strptime(meeting.start, FORMAT).timestamp()
+    assert event["end_ts"] - event["start_ts"] == 3600
+    assert event["span_end_ts"] == event["end_ts"] + 2 * 7 * 24 * 3600
+    assert event["rrule_rfc"] == "FREQ=WEEKLY;COUNT=3" and event["dtstart_ts"] == event["start_ts"]
+    assert stamped(event) is event
+    assert event_rule(event) is meeting.rule()
+    deltas = Reminders.UserDeltas(days=1, minutes=30)
+    assert deltas.apply_ts(event["start_ts"]) == [event["start_ts"] - 24 * 3600, event["start_ts"] - 30 * 60]
+
+
+def test_build_schedules():
+    day = 24 * 3600
+    targets = [float(n * day) for n in range(0, 365)]
+    schedules = Reminders.UserDeltas(weeks=1, hours=1).schedules(targets)
+    assert len(schedules) == 2 * 365 and schedules == sorted(schedules)
+    assert schedules[:3] == [-7 * day, -6 * day, -5 * day]
+    assert schedules[-1] == 364 * day - 3600
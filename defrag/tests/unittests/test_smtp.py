@@ -0,0 +1,63 @@
+from defrag.modules.helpers.smtp import SMTPPool
+from typing import List
+import asyncio
+import pytest
+
+
+async def smtp_stand_in(received: List[str], connections: List[int], rejected: str = "rejected"):
+    """ Just enough of an SMTP server for smtplib to send messages to. Refuses the recipients containing 'rejected'. """
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        connections.append(1)
+        writer.write(b"220 stand-in ready\r\n")
+        while line := await reader.readline():
+            command = line.decode().strip().upper()
+            if command.startswith("DATA"):
+                writer.write(b"354 go ahead\r\n")
+                await writer.drain()
+                data = []
+                while (line := await reader.readline()) != b".\r\n":
+                    data.append(line.decode())
+                received.append("".join(data))
+                writer.write(b"250 queued\r\n")
+            elif command.startswith("RCPT") and rejected.upper() in command:
+                writer.write(b"550 no such user\r\n")
+            elif command.startswith("QUIT"):
+                writer.write(b"221 bye\r\n")
+                break
+            else:
+                writer.write(b"250 ok\r\n")
+            await writer.drain()
+        writer.close()
+    return await asyncio.start_server(handle, "127.0.0.1", 0)
+
+
+@pytest.mark.asyncio
+async def test_smtp_pool():
+    received, connections = [], []
+    server = await smtp_stand_in(received, connections)
+    port = server.sockets[0].getsockname()[1]
+    pool = SMTPPool("127.0.0.1", port, sender="defrag@localhost", size=2)
+    messages = [pool.make_message(f"user{n}@localhost", "reminder", "meeting soon") for n in range(0, 10)]
+    errors = await asyncio.gather(pool.send(messages[:5]), pool.send(messages[5:]))
+    errors += [await pool.send(messages[:1])]
+    await pool.close()
+    server.close()
+    assert not any(e for batch in errors for e in batch)
+    assert len(received) == 11
+    assert len(connections) == 2
+
+
+@pytest.mark.asyncio
+async def test_smtp_rejection():
+    received, connections = [], []
+    server = await smtp_stand_in(received, connections)
+    port = server.sockets[0].getsockname()[1]
+    pool = SMTPPool("127.0.0.1", port, sender="defrag@localhost", size=1)
+    messages = [pool.make_message(to, "reminder", "meeting soon") for to in ["rejected@localhost", "user@localhost"]]
+    errors = await pool.send(messages)
+    await pool.close()
+    server.close()
+    assert errors[0] and not errors[1]
+    # the session outlives the rejection, and the rejected message is not sent again
+    assert len(received) == 1
+    assert len(connections) == 1
@@ -1,3 +1,4 @@
+import asyncio
 from defrag import app
 from defrag.modules.db.redis import RedisPool
 from defrag.modules.suggestions import Suggestions
@@ -23,6 +24,70 @@ async def test_voting():
     assert res
 
 
+@pytest.mark.asyncio
+async def test_top():
+    with RedisPool() as conn:
+        conn.flushall()
+    keys = [(await Suggestions.add(Suggestions.New(title=f"suggestion {n}", description="...", creator_id="user0"))).ok for n in range(5)]
+    for n, key in enumerate(keys):
+        for voter in range(n):
+            await Suggestions.cast_vote(f"user{voter + 1}", key, 1)
+    ranked = [i["key"] for i in sorted(Suggestions.container.values(), key=lambda i: i["score"], reverse=True)]
+    top = (await Suggestions.view(limit=2)).ok
+    assert [i["key"] for i in top] == ranked[:2]
+    page = (await Suggestions.view(offset=2, limit=2)).ok
+    assert [i["key"] for i in page] == ranked[2:4]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_votes():
+    with RedisPool() as conn:
+        conn.flushall()
+    key = (await Suggestions.add(Suggestions.New(title="title", description="...", creator_id="user0"))).ok
+    results = await asyncio.gather(*[Suggestions.cast_vote(f"user{n % 20}", key, n % 2) for n in range(40)])
+    assert len([r for r in results if hasattr(r, "ok")]) == 19
+    item = Suggestions.container[key]
+    assert item["votesFor"] + item["votesAgainst"] == 20
+    assert item["score"] == Suggestions.make_score(item["votesFor"], item["votesAgainst"])
+    with RedisPool() as conn:
+        assert conn.zscore(Suggestions.scores_key, key) == item["score"]
+        assert conn.scard(Suggestions.voters_key(key)) == 20
+
+
+@pytest.mark.asyncio
+async def test_bulk_votes():
+    with RedisPool() as conn:
+        conn.flushall()
+    key = (await Suggestions.add(Suggestions.New(title="title", description="...", creator_id="user0"))).ok
+    votes = [Suggestions.Vote(voter_id=f"user{n}", sugg_id=key, vote=n % 2) for n in range(1, 11)]
+    votes += [Suggestions.Vote(voter_id="user1", sugg_id=key, vote=1), Suggestions.Vote(voter_id="user1", sugg_id="unknown", vote=1)]
+    results = await Suggestions.cast_votes(votes)
+    assert [hasattr(r, "ok") for r in results] == [True] * 10 + [False, False]
+    item = Suggestions.container[key]
+    assert (item["votesFor"], item["votesAgainst"]) == (6, 5)
+
+
+@pytest.mark.asyncio
+async def test_rescoring():
+    with RedisPool() as conn:
+        conn.flushall()
+    # scored with the former formula, which favoured the least voted suggestions
+    legacy = [{"key": "many", "votesFor": 10, "votesAgainst": 0, "score": 0.8}, {"key": "few", "votesFor": 1, "votesAgainst": 0, "score": 2.52}]
+    for item in legacy:
+        Suggestions.container[item["key"]] = {**item, "title": item["key"], "voters_ids": []}
+    Suggestions.scores_checked = False
+    # another worker is rescoring them
+    with RedisPool() as conn:
+        conn.set(Suggestions.scores_migration_key, 1)
+    assert Suggestions.top() == [] and not Suggestions.scores_checked
+    with RedisPool() as conn:
+        conn.delete(Suggestions.scores_migration_key)
+    top = (await Suggestions.view()).ok
+    assert [i["key"] for i in top] == ["many", "few"]
+    assert top[0]["score"] == Suggestions.make_score(10, 0)
+    assert Suggestions.scores_checked and not "voters_ids" in top[0]
+
+
 def test_create():
     with RedisPool() as conn:
         conn.flushall()